@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# Micro-benchmark for the console output filter used by SSHClient.execute(filtered=True).
+# It replays recorded sunbeam console output (a Jenkins console log passed with -f, or
+# a built-in sample that mimics a bootstrap with its spinner updates) through the old
+# per-line implementation and through outputfilter, and prints lines per second.
+# Both are checked to produce the same output so that a speedup never hides a change.
+
+import argparse
+import re
+import time
+from outputfilter import DEFAULT_FILTER
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-f", "--file", help="recorded console output to replay")
+parser.add_argument("-r", "--repeat", type=int, default=5, help="rounds to run each filter")
+args = parser.parse_args()
+
+
+def legacy_filter(raw_lines):
+    """The filter as it was before outputfilter (recompiling per raw line)"""
+
+    def strip_garbage(line):
+        line = re.sub(r" *$", '', line)
+        line = re.sub(r"\x1b\[\??[0-9;]*[hlmAGKHF]", '', line)
+        line = re.sub("^((Ensure prerequisites|Download snap|Fetch and check assertions|"
+            "Mount snap|Setup snap|Copy snap|Connect .* to|Run health check|"
+            "Run install hook|Start snap|Run service command|"
+            "Run configure hook|Automatically connect eligible plugs).*?)"
+            " +([-\\\\|/]|[0-9]+% .*)$", r'\1', line)
+        line = re.sub("[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏] *", '> ', line)
+        if r"(Reading database ..." in line:
+            line = ""
+        return line
+
+    last_line = None
+    delayed_line = None
+    output = ""
+    for lineraw in raw_lines:
+        detect_two_lines = re.compile(
+            r"> Deploying OpenStack Control Plane to Kubernetes \(this may take a while\)|"
+            r"> Resizing OpenStack Control Plane to match appropriate topology|"
+            r"> Applying local hypervisor settings \.\.\. setting hypervisor configuration for|"
+            r"> No sunbeam key found in OpenStack\. Creating SSH key at|"
+            r"> Enabling OpenStack telemetry application \.\.\. waiting for services to come|"
+            r"> Enabling OpenStack observability application \.\.\. waiting for services to come|"
+            r"> Enabling OpenStack validation application ... waiting for services to come|"
+            r"> Applying hypervisor settings ... setting hypervisor configuration for|"
+            r"> Copying .* from tempest")
+        for line in lineraw.rstrip().split("\r"):
+            line = strip_garbage(line)
+            if not line:
+                continue
+            if delayed_line:
+                line = f"{delayed_line} {line}"
+                delayed_line = None
+            elif detect_two_lines.search(line):
+                delayed_line = line
+                continue
+            if line != last_line:
+                last_line = line
+            output += f"{line}\n"
+    return output
+
+
+def new_filter(raw_lines):
+    stream = DEFAULT_FILTER.stream()
+    return "".join(stream.feed(lineraw)[0] for lineraw in raw_lines)
+
+
+def sample_lines():
+    """Something that looks like a bootstrap seen through a pty"""
+    spinner = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
+    lines = []
+    for pct in range(0, 100, 5):
+        lines.append(f"Download snap \"openstack\" (512) from channel \"2024.1/edge\"   "
+                     f"{pct}% 12.3MB/s 1m2s\r")
+    lines.append("Setup snap \"openstack\" (512) security profiles  \\ \n")
+    for step in range(200):
+        updates = "".join(
+            f"\x1b[?25l\x1b[2K{spinner[n % 10]} Deploying OpenStack Control Plane to "
+            f"Kubernetes (this may take a while) ... waiting for services {step}\r"
+            for n in range(20))
+        lines.append(f"{updates}\x1b[0m   \n")
+        lines.append(f"\x1b[32m⠙ Adding cloud to Juju client ... \x1b[0m done {step}\n")
+    lines.append("(Reading database ... 73648 files and directories currently installed.)\n")
+    return lines
+
+
+if args.file:
+    with open(args.file, "r", encoding="utf-8", errors="replace") as fd:
+        raw_lines = fd.readlines()
+else:
+    raw_lines = sample_lines()
+# count what the filter actually sees, the \r separated updates in each raw line
+total_lines = sum(len(lineraw.split("\r")) for lineraw in raw_lines)
+
+if legacy_filter(raw_lines) != new_filter(raw_lines):
+    print("WARNING: legacy and new filters produced different output")
+
+for name, function in (("legacy", legacy_filter), ("outputfilter", new_filter)):
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        function(raw_lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:>12}: {total_lines} lines in {best:.3f}s = {total_lines / best:,.0f} lines/s")
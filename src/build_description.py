@@ -17,12 +17,6 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-j", "--job-name", required=True)
 parser.add_argument("-b", "--build-number", required=True)
 parser.add_argument("-n", "--dry-run", action="store_true")
-args = parser.parse_args()
-
-# Construct some paths
-BUILD_DIR = f"../../jobs/{args.job_name}/builds/{args.build_number}" # relative to workspace dir
-CONSOLE_LOG_FILE = f"{BUILD_DIR}/log" # this is a file with console logs
-ARCHIVE_DIR = f"{BUILD_DIR}/archive" # this is a directory that holds artifacts
 
 EXTRA_INFO_RE = [
     [
@@ -57,48 +51,61 @@ EXTRA_INFO_RE = [
 #    ]
 #]
 
-utils.debug(f"Creating description for job_name={args.job_name} build_number={args.build_number}")
-
-console_log = utils.read_file(CONSOLE_LOG_FILE) # read whole file as one string
-
-# Get the basic information (snap release, die message, etc.)
-
-groups = re.findall('Download snap "openstack" \((.*)\) from channel "(.*)"', console_log)
-groups = re.findall(
-    "snap_output='openstack +([^ ]+) +([^ ]+) +([^ ]+) +canonical\*\* +-'",
-    console_log)
-os_snap_release = groups[0][1] if groups else "n/a"
-os_snap_channel = groups[0][2] if groups else "n/a"
-groups = re.findall(' DIE: (.*)$', console_log, re.MULTILINE)
-die_message = groups[0] if groups else "n/a"
-
-# Try to add some more info on fail reason
-for item in EXTRA_INFO_RE:
-    if re.search(item[1], console_log):
-        extra_info = item[0]
-        break
-else:
-    extra_info = "n/a"
-
-## Try to list all hacks needed, TODO: make them cumulative
-#for item in HACKS_RE:
-#    if re.search(item[1], console_log):
-#        hacks_needed = item[0]
-#        break
-#else:
-#    hacks_needed = "n/a"
-
-rendered_template = textwrap.dedent(f"""\
-    openstack_snap: {os_snap_channel} ({os_snap_release})
-    die_message: {die_message}
-    extra_info: {extra_info}
-""")
-    #hacks_needed: {hacks_needed}
-
-utils.debug(f"Rendered template: \n{rendered_template.rstrip()}")
-
-# Instead of saving description file in workspace/artifacts and let it be copied to the
-# archive, point directly to the archive dir so that this is script is generic enough
-# to be executed outside of a build env. THIS MUST COME AFTER archiveArtifacts in JenkinsFile.
-if not args.dry_run:
-    utils.write_file(rendered_template, f"{ARCHIVE_DIR}/build-description.txt")
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    # Construct some paths
+    build_dir = f"../../jobs/{args.job_name}/builds/{args.build_number}" # relative to workspace dir
+    console_log_file = f"{build_dir}/log" # this is a file with console logs
+    archive_dir = f"{build_dir}/archive" # this is a directory that holds artifacts
+
+    utils.debug(f"Creating description for job_name={args.job_name} build_number={args.build_number}")
+
+    console_log = utils.read_file(console_log_file) # read whole file as one string
+
+    # Get the basic information (snap release, die message, etc.)
+
+    groups = re.findall('Download snap "openstack" \((.*)\) from channel "(.*)"', console_log)
+    groups = re.findall(
+        "snap_output='openstack +([^ ]+) +([^ ]+) +([^ ]+) +canonical\*\* +-'",
+        console_log)
+    os_snap_release = groups[0][1] if groups else "n/a"
+    os_snap_channel = groups[0][2] if groups else "n/a"
+    groups = re.findall(' DIE: (.*)$', console_log, re.MULTILINE)
+    die_message = groups[0] if groups else "n/a"
+
+    # Try to add some more info on fail reason
+    for item in EXTRA_INFO_RE:
+        if re.search(item[1], console_log):
+            extra_info = item[0]
+            break
+    else:
+        extra_info = "n/a"
+
+    ## Try to list all hacks needed, TODO: make them cumulative
+    #for item in HACKS_RE:
+    #    if re.search(item[1], console_log):
+    #        hacks_needed = item[0]
+    #        break
+    #else:
+    #    hacks_needed = "n/a"
+
+    rendered_template = textwrap.dedent(f"""\
+        openstack_snap: {os_snap_channel} ({os_snap_release})
+        die_message: {die_message}
+        extra_info: {extra_info}
+    """)
+        #hacks_needed: {hacks_needed}
+
+    utils.debug(f"Rendered template: \n{rendered_template.rstrip()}")
+
+    # Instead of saving description file in workspace/artifacts and let it be copied to the
+    # archive, point directly to the archive dir so that this is script is generic enough
+    # to be executed outside of a build env. THIS MUST COME AFTER archiveArtifacts in JenkinsFile.
+    if not args.dry_run:
+        utils.write_file(rendered_template, f"{archive_dir}/build-description.txt")
+
+
+if __name__ == "__main__":
+    main()
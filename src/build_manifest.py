@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+# This script builds the merged deployment manifest for a profile without any
+# substrate: the snap overlay for channelcp is taken from the local cache, or
+# from the snap downloaded on this machine, and merged with the profile manifest
+# as the deploy scripts do. It validates the result and can diff it against
+# another channel/channelcp or a manifest file (i.e. manifest.yaml of an old
+# build's artifacts), so that manifest problems show up in seconds.
+#
+# Only the manifest from the profile is used, values filled by the substrate at
+# build time (like microceph_config) are not there.
+
+import argparse
+import difflib
+import sys
+import manifests
+import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-p", "--profile", required=True, help="profile from profiles.yaml")
+parser.add_argument("-c", "--channel", required=True, help="openstack snap channel")
+parser.add_argument("-C", "--channelcp", required=True, help="control plane channel")
+parser.add_argument("-o", "--output", help="write the merged manifest to this file")
+group = parser.add_mutually_exclusive_group()
+group.add_argument("--diff-channel", nargs=2, metavar=("CHANNEL", "CHANNELCP"),
+                   help="diff against the manifest built for another channel and channelcp")
+group.add_argument("--diff-file", help="diff against a manifest file")
+args = parser.parse_args()
+
+
+def build(channel, channelcp):
+    overlay = manifests.offline_overlay(channel, channelcp)
+    return manifests.merge(profile_data["manifest"], overlay)
+
+
+profile_data = utils.read_profiles().get(args.profile)
+if not profile_data:
+    utils.die(f"Invalid profile '{args.profile}', please check profiles.yaml")
+
+manifest = build(args.channel, args.channelcp)
+manifest_dump = utils.yaml_dump(manifest)
+
+if args.output:
+    utils.write_file(manifest_dump, args.output)
+elif not (args.diff_channel or args.diff_file):
+    print(manifest_dump, end="")
+
+rc = 0
+if problems := manifests.validate(manifest):
+    rc = 1
+    for problem in problems:
+        utils.debug(f"PROBLEM: {problem}")
+else:
+    utils.debug("manifest is valid")
+
+if args.diff_channel or args.diff_file:
+    if args.diff_channel:
+        other_dump = utils.yaml_dump(build(*args.diff_channel))
+        other_name = "/".join(args.diff_channel)
+    else:
+        other_dump = utils.yaml_dump(utils.yaml_safe_load(utils.read_file(args.diff_file)))
+        other_name = args.diff_file
+    diff = difflib.unified_diff(
+        other_dump.splitlines(keepends=True), manifest_dump.splitlines(keepends=True),
+        fromfile=other_name, tofile=f"{args.channel}/{args.channelcp}")
+    sys.stdout.writelines(diff)
+
+sys.exit(rc)
@@ -0,0 +1,104 @@
+#!/bin/false
+
+"""
+Records which deploy steps have completed in a state file next to config.yaml,
+so that a deploy that failed late (i.e. at configure, after a long bootstrap)
+can be resumed with --resume instead of starting over from a new substrate.
+
+Each step is recorded with a hash of its inputs and whatever outputs later
+steps need (i.e. join tokens), only function steps have outputs worth keeping
+(see steps.Step). On resume a step is skipped only if it was recorded with the
+same inputs and its check still holds on the remote side.
+The state is discarded if config.yaml changed (a new substrate was built).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import utils
+
+STATE_FILE = "deploy-state.yaml"
+
+
+def fingerprint(data):
+    """A stable hash of any yaml/json serializable data"""
+    dumped = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(dumped.encode("utf-8")).hexdigest()
+
+
+class Checkpoint:
+
+    def __init__(self, config, resume=False, filename=None):
+        self.filename = filename = filename or utils.run_path(STATE_FILE)
+        self.resume = resume
+        self.lock = threading.Lock()
+        config_hash = fingerprint(config)
+        self.state = {"config": config_hash, "steps": {}}
+        if resume:
+            if not os.path.isfile(filename):
+                utils.debug(f"CHECKPOINT: no {filename} found, nothing to resume")
+            elif (state := utils.yaml_safe_load(utils.read_file(filename))) \
+                    and state.get("config") == config_hash:
+                self.state = state
+                utils.debug(f"CHECKPOINT: resuming, completed steps are "
+                            f"{list(self.state['steps'])}")
+            else:
+                utils.debug("CHECKPOINT: config changed since last run, not resuming")
+        self.__save()
+
+
+    def __save(self):
+        utils.replace_file(utils.yaml_dump(self.state), self.filename)
+
+
+    def done(self, step, inputs=None, check=None):
+        """Tells if step can be skipped: it was recorded with the same inputs and
+           check() (if given) returns True. A step that does not qualify is
+           forgotten"""
+        with self.lock:
+            recorded = self.state["steps"].get(step)
+        if not recorded:
+            return False
+        if recorded["inputs"] != fingerprint(inputs):
+            utils.debug(f"CHECKPOINT: step '{step}' inputs changed, running it again")
+        elif check and not check():
+            utils.debug(f"CHECKPOINT: step '{step}' does not hold on remote, running it again")
+        else:
+            utils.debug(f"CHECKPOINT: step '{step}' already done, skipping")
+            return True
+        self.forget(step)
+        return False
+
+
+    def outputs(self, step):
+        """The outputs recorded for step (empty dict if none)"""
+        with self.lock:
+            return dict(self.state["steps"].get(step, {}).get("outputs", {}))
+
+
+    def record(self, step, inputs=None, outputs=None):
+        """Marks step as completed with the given inputs and outputs"""
+        utils.debug(f"CHECKPOINT: step '{step}' completed")
+        with self.lock:
+            self.state["steps"][step] = {
+                "inputs": fingerprint(inputs),
+                "outputs": outputs or {},
+            }
+            self.__save()
+
+
+    def forget(self, step):
+        with self.lock:
+            if self.state["steps"].pop(step, None):
+                self.__save()
+
+
+def remote_check(sshclient, cmd):
+    """Returns a check for Checkpoint.done that passes when cmd succeeds remotely"""
+
+    def check():
+        out, rc = sshclient.execute(cmd)
+        return rc == 0
+
+    return check
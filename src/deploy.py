@@ -1,29 +1,35 @@
 #!/usr/bin/python3 -u
 
-import os
-import sys
+import argparse
+import deploy_deployment
+import deploy_standalone
 import utils
 
-# Because these deployment scripts are very long it is not easy to enclose them in
-# functions, it is hard to use "import" on the scripts without some hacking..
-# Since they are mostly independent from the rest of the system and just need to
-# read the config file to work correctly, we simply invoke them as external
-# commands instead.
-
-# No need to pass parameters since it will know where to read the config from.
-# They are executed as subprocesses and will return to this script at the end.
-
-config = utils.read_config()
-
-substrate = config["substrate"]
-if substrate in ("equinix", "maas"):
-    utils.debug(f"Starting deploy for substrate {substrate}, executing 'deploy_standalone.py'")
-    rc = os.system("./src/deploy_standalone.py")
-elif substrate == "maasdeployment":
-    utils.debug(f"Starting deploy for substrate {substrate}, executing 'deploy_deployment.py'")
-    rc = os.system("./src/deploy_deployment.py")
-else:
-    utils.die(f"Invalid substrate '{substrate}' in config, aborting")
-
-# pass along the exit code from subprocess
-sys.exit(os.waitstatus_to_exitcode(rc))
+# The deployment scripts read everything they need from the config file, each
+# one has a main() so they run in this same process (sharing the parsed config
+# and ssh connections), --resume is passed along.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", action="store_true",
+                    help="skip the steps that completed in a previous (failed) run")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    deploy_args = ["--resume"] if args.resume else []
+
+    config = utils.read_config()
+
+    substrate = config["substrate"]
+    if substrate in ("equinix", "maas"):
+        utils.debug(f"Starting deploy for substrate {substrate}, running 'deploy_standalone'")
+        deploy_standalone.main(deploy_args)
+    elif substrate == "maasdeployment":
+        utils.debug(f"Starting deploy for substrate {substrate}, running 'deploy_deployment'")
+        deploy_deployment.main(deploy_args)
+    else:
+        utils.die(f"Invalid substrate '{substrate}' in config, aborting")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,150 +3,170 @@
 """
 This script deploys sunbeam on a previously prepared maas substrate, using
 'deployments' feature where sunbeam drives maas directly.
+
+Everything runs from the sunbeam client so the steps (see steps.py) form a
+single chain, the graph mostly makes the timing of each of them explicit.
 """
 
+import argparse
+import checkpoint
+import manifests
+import retrypolicy
+import snapcache
+import steps
+import tracing
 import utils
-from sshclient import SSHClient
-
-
-config = utils.read_config()
-user = config["user"]
-sunbeam_client = config["sunbeam_client"]
-channel = config["channel"]
-channelcp = config.get("channelcp", "")
-deployment_name = config["deployment_name"]
-api_url = config["api_url"]
-api_key = config["api_key"]
-manifest = config["manifest"]
-
-utils.debug(f"starting MAAS Deployment, using sunbeam-client at {sunbeam_client}")
-
-p_sshclient = SSHClient(user, sunbeam_client)
-
-cmd = f"sudo snap install openstack --channel {channel}"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("installing openstack snap failed, aborting")
-
-cmd = "sunbeam prepare-node-script --client | bash -x"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("running prepare-node-script failed, aborting")
-
-# register deployment itself
-cmd = f"""
-    sunbeam deployment add maas \
-        {deployment_name} \
-        {api_key} \
-        {api_url} || :
-"""
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("registering MAAS deployment failed, aborting")
-
-# map spaces
-cmd = "set -xe\n"
-try:
-    default_space = config["default_space"]
-    cmd += f"sunbeam deployment space map {default_space}"
-except KeyError:
-    spaces_mapping = config["spaces_mapping"]
-    for network, space in spaces_mapping.items():
-        cmd += f"sunbeam deployment space map {space} {network}\n"
-except KeyError:
-    utils.die("Either default_space or spaces_mapping is required")
-
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("mapping networks to spaces failed, aborting")
-
-# validate the deployment before starting
-# this will not block or prevent deployment, it will just generate a report
-# at /home/ubuntu/snap/openstack/common/reports/validate-deployment-*.yaml
-cmd = "sunbeam deployment validate"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-# this is about failure of running the command, not about the result of the validation
-if rc != 0:
-    utils.die("validating the deployment failed, aborting")
-
-# The snap carries a few manifest override files that you can use
-# to force candidate, edge, etc for the control plane (default is
-# stable channel for CP even for non-stable openstack snaps)
-snap_manifest_file = f"/snap/openstack/current/etc/manifests/{channelcp}.yml"
-if channelcp == "stable":
-    # for stable, we just do nothing, it's the default
-    utils.debug("deploying control plane with 'stable' channels, no snap manifest needed")
-elif channelcp in ("candidate", "beta", "edge"):
-    # for others we merge default manifest from snap with ours
-    utils.debug(f"deploying control plane with {channelcp} channels, loading snap manifest")
-    manifest_temp = utils.yaml_safe_load(p_sshclient.file_read(snap_manifest_file))
-    # Get a merged manifest using the snap one for defaults
-    manifest = utils.merge_dicts(manifest_temp, manifest)
-else:
-    utils.die("Missing or invalid 'channelcp' value")
-
-manifest_dump = utils.yaml_dump(manifest)
-utils.debug(f"Manifest contents are:\n{manifest_dump.rstrip()}")
-p_sshclient.file_write("manifest.yaml", manifest_dump)
-
-cmd = "sunbeam cluster bootstrap -m ~/manifest.yaml"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-# hack for websocket error
-if rc == 1001:
-    utils.debug("Retrying because of websocker error")
-    out, rc = p_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("bootstrapping sunbeam failed, aborting")
-
-cmd = "sunbeam cluster list"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    #utils.die("listing sunbeam cluster nodes failed, aborting")
-    utils.debug("listing sunbeam cluster nodes failed -- ignoring")
-
-cmd = "sunbeam cluster deploy"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("running cluster deploy failed, aborting")
-
-cmd = "sunbeam cluster list"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    #utils.die("listing sunbeam cluster nodes failed, aborting")
-    utils.debug("listing sunbeam cluster nodes failed -- ignoring")
-
-cmd = "sunbeam configure --openrc ~/demo-openrc && echo >> ~/demo-openrc"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("configuring demo project failed, aborting")
-
-cmd = "sunbeam openrc > ~/admin-openrc"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("exporting admin credentials failed, aborting")
-
-p_sshclient.close()
+import watchdog
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", action="store_true",
+                    help="skip the steps that completed in a previous (failed) run")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    tracing.start_stage("deploy")
+
+    config = utils.read_config()
+    checkpoints = checkpoint.Checkpoint(config, resume=args.resume)
+    user = config["user"]
+    sunbeam_client = config["sunbeam_client"]
+    channel = config["channel"]
+    channelcp = config.get("channelcp", "")
+    deployment_name = config["deployment_name"]
+    api_url = config["api_url"]
+    api_key = config["api_key"]
+
+    utils.debug(f"starting MAAS Deployment, using sunbeam-client at {sunbeam_client}")
+
+    def install_snap(sshclient, results):
+        snap_cached = None
+        if config.get("snap_cache"):
+            snap_cached = snapcache.fetch("openstack", channel, config["snap_cache"])
+        if snap_cached:
+            out, rc = snapcache.install(sshclient, "openstack", channel, snap_cached)
+        else:
+            cmd = f"sudo snap install openstack --channel {channel}"
+            out, rc = sshclient.execute(cmd, **steps.EXECUTE_ARGS)
+        utils.debug(f"execute return code is {rc}")
+        if rc != 0:
+            utils.die("installing openstack snap failed, aborting")
+
+    def spaces_cmd():
+        cmd = "set -xe\n"
+        try:
+            default_space = config["default_space"]
+            cmd += f"sunbeam deployment space map {default_space}"
+        except KeyError:
+            spaces_mapping = config["spaces_mapping"]
+            for network, space in spaces_mapping.items():
+                cmd += f"sunbeam deployment space map {space} {network}\n"
+        except KeyError:
+            utils.die("Either default_space or spaces_mapping is required")
+        return cmd
+
+    def build_manifest(sshclient, results):
+        # The snap carries a few manifest override files that you can use
+        # to force candidate, edge, etc for the control plane (default is
+        # stable channel for CP even for non-stable openstack snaps)
+        overlay = manifests.node_overlay(sshclient, channelcp)
+        # Get a merged manifest using the snap one for defaults
+        manifest = manifests.merge(config["manifest"], overlay)
+        if problems := manifests.validate(manifest):
+            utils.die(f"invalid manifest: {problems}")
+
+        manifest_dump = utils.yaml_dump(manifest)
+        utils.debug(f"Manifest contents are:\n{manifest_dump.rstrip()}")
+        sshclient.file_write("manifest.yaml", manifest_dump)
+        return {"manifest": manifest_dump}
+
+    # bootstrap and the like can go silent for an hour before they time out, get
+    # diagnostics meanwhile and give up early if things are not going to recover
+    deploy_watchdog = watchdog.Watchdog(abort=True)
+
+    runner = steps.StepRunner(user, checkpoints=checkpoints)
+
+    runner.add(steps.Step(
+        "install", function=install_snap, host=sunbeam_client,
+        inputs=channel, check="snap list openstack"))
+
+    runner.add(steps.Step(
+        "prepare", "sunbeam prepare-node-script --client | bash -x",
+        host=sunbeam_client, deps=["install"],
+        error="running prepare-node-script failed, aborting",
+        check="id -nG | grep -qw snap_daemon", reconnect=True))
+
+    # register deployment itself
+    runner.add(steps.Step(
+        "register", f"""
+            sunbeam deployment add maas \
+                {deployment_name} \
+                {api_key} \
+                {api_url} || :
+        """, host=sunbeam_client, deps=["prepare"],
+        error="registering MAAS deployment failed, aborting",
+        inputs=[deployment_name, api_url],
+        check=f"sunbeam deployment list | grep -qw {deployment_name}"))
+
+    # map spaces (quick and can be mapped again, always run)
+    runner.add(steps.Step(
+        "spaces", spaces_cmd(), host=sunbeam_client, deps=["register"],
+        error="mapping networks to spaces failed, aborting", resumable=False))
+
+    # validate the deployment before starting
+    # this will not block or prevent deployment, it will just generate a report
+    # at /home/ubuntu/snap/openstack/common/reports/validate-deployment-*.yaml
+    # (the step fails on failure of running the command, not on the result of the validation)
+    runner.add(steps.Step(
+        "validate", "sunbeam deployment validate", host=sunbeam_client, deps=["spaces"],
+        error="validating the deployment failed, aborting", resumable=False))
+
+    runner.add(steps.Step(
+        "manifest", function=build_manifest, host=sunbeam_client, deps=["validate"],
+        resumable=False))
+
+    runner.add(steps.Step(
+        "bootstrap", "sunbeam cluster bootstrap -m ~/manifest.yaml",
+        host=sunbeam_client, deps=["manifest"],
+        error="bootstrapping sunbeam failed, aborting",
+        retry_policy=retrypolicy.CLUSTER_POLICY, watchdog=deploy_watchdog,
+        inputs=lambda results: results["manifest"]["manifest"],
+        check="sunbeam cluster list"))
+
+    runner.add(steps.Step(
+        "bootstrap-list", "sunbeam cluster list", host=sunbeam_client, deps=["bootstrap"],
+        check_rc=False, resumable=False))
+
+    runner.add(steps.Step(
+        "cluster-deploy", "sunbeam cluster deploy", host=sunbeam_client, deps=["bootstrap-list"],
+        error="running cluster deploy failed, aborting",
+        retry_policy=retrypolicy.CLUSTER_POLICY, watchdog=deploy_watchdog,
+        inputs=lambda results: results["manifest"]["manifest"],
+        # the openstack model is there and settled, not just created
+        check="""juju show-model openstack >/dev/null && \
+            juju wait-for model openstack --timeout 1m \
+                --query='forEach(units, unit => unit.workload-status == "active")'"""))
+
+    runner.add(steps.Step(
+        "deploy-list", "sunbeam cluster list", host=sunbeam_client, deps=["cluster-deploy"],
+        check_rc=False, resumable=False))
+
+    runner.add(steps.Step(
+        "configure", "sunbeam configure --openrc ~/demo-openrc && echo >> ~/demo-openrc",
+        host=sunbeam_client, deps=["deploy-list"],
+        error="configuring demo project failed, aborting",
+        retry_policy=retrypolicy.DEFAULT_POLICY, watchdog=deploy_watchdog,
+        check="test -s ~/demo-openrc"))
+
+    runner.add(steps.Step(
+        "openrc", "sunbeam openrc > ~/admin-openrc", host=sunbeam_client, deps=["configure"],
+        error="exporting admin credentials failed, aborting",
+        check="test -s ~/admin-openrc"))
+
+    runner.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,213 +2,215 @@
 
 """
 This script deploys sunbeam on a substrate that has already been prepared for it.
+
+The deploy is described as a graph of steps (see steps.py): all nodes get the
+snap installed and prepared at the same time, the primary bootstraps as soon as
+it is prepared and only the add/join handshake with the primary happens in order.
 """
 
+import argparse
+import checkpoint
+import manifests
+import retrypolicy
+import snapcache
+import steps
+import tracing
 import utils
-from sshclient import SSHClient
-
-
-config = utils.read_config()
-
-# order hosts to have control nodes first, then separete primary node from others
-nodes = list(filter(lambda x: 'control' in x["roles"], config["nodes"]))
-control_count = len(nodes)
-nodes += list(filter(lambda x: 'control' not in x["roles"], config["nodes"]))
-utils.debug(f"detected count of control nodes is {control_count}")
-utils.debug(f"detected count of total nodes is {len(nodes)}")
-utils.debug(f"complete list of nodes: {nodes}")
-primary_node = nodes.pop(0)
-utils.debug(f"selected primary node: {primary_node}")
-utils.debug(f"secondary nodes list: {nodes}")
-
-### Primary node / bootstrap
-
-user = config["user"]
-p_host_name_int = primary_node["host-name-int"]
-p_host_name_ext = primary_node["host-name-ext"]
-p_host_ip_int = primary_node["host-ip-int"]
-p_host_ip_ext = primary_node["host-ip-ext"]
-
-utils.debug(f"installing primary node {p_host_name_ext} / {p_host_ip_ext} " \
-            f"/ {p_host_name_int} / {p_host_ip_int}")
-
-p_sshclient = SSHClient(user, p_host_ip_ext)
-
-cmd = f"sudo snap install openstack --channel {config['channel']}"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("installing openstack snap failed, aborting")
-
-cmd = "sunbeam prepare-node-script | grep -v newgrp | bash -x"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("running prepare-node-script failed, aborting")
-
-utils.debug("Force new SSH connection to activate new groups on remote user")
-p_sshclient.close()
-
-manifest = config["manifest"]
-
-# The snap carries a few manifest override files that you can use
-# to force candidate, edge, etc for the control plane (default is
-# stable channel for CP even for non-stable openstack snaps)
-channelcp = config.get("channelcp", "")
-snap_manifest_file = f"/snap/openstack/current/etc/manifests/{channelcp}.yml"
-if channelcp == "stable":
-    # for stable, we just do nothing, it's the default
-    utils.debug("deploying control plane with 'stable' channels, no snap manifest needed")
-elif channelcp in ("candidate", "beta", "edge"):
-    # for others we merge default manifest from snap with ours
-    utils.debug(f"deploying control plane with {channelcp} channels, loading snap manifest")
-    manifest_temp = utils.yaml_safe_load(p_sshclient.file_read(snap_manifest_file))
-    # Get a merged manifest using the snap one for defaults
-    manifest = utils.merge_dicts(manifest_temp, manifest)
-else:
-    utils.die("Missing or invalid 'channelcp' value")
-
-# Any other override that we may want to do on manifest can go here
-# This will be valid for all profiles. It can go into the config
-# file instead if it's for a specific profile.
-# more doc at https://discourse.ubuntu.com/t/deployment-manifest/42672/5
-#manifest.update({
-    #"juju": {
-    #    "bootstrap_args": [ "--debug" ],
-    #},
-    #"charms": {
-    #    "microk8s": { config: { containerd_env: "..."}, custom_registries: [ { url: "...", host: "...", } ], },
-    #    "keystone-k8s": { "channel": "2023.2/edge" },
-    #},
-#})
-
-manifest_dump = utils.yaml_dump(manifest)
-utils.debug(f"Manifest contents are:\n{manifest_dump.rstrip()}")
-p_sshclient.file_write("manifest.yaml", manifest_dump)
-
-cmd = "sunbeam cluster bootstrap -m ~/manifest.yaml"
-for role in primary_node["roles"]:
-    cmd += f" --role {role}"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-# hack for websocket error
-if rc == 1001:
-    utils.debug("Retrying because of websocker error")
-    out, rc = p_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("bootstrapping sunbeam failed, aborting")
-
-cmd = "sunbeam cluster list"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-
-### Other nodes
-
-for node in nodes:
-    s_host_name_int = node["host-name-int"]
-    s_host_name_ext = node["host-name-ext"]
-    s_host_ip_int = node["host-ip-int"]
-    s_host_ip_ext = node["host-ip-ext"]
-
-    utils.debug(f"installing seconday node {s_host_name_ext} / {s_host_ip_ext} " \
-                f"/ {s_host_name_int} / {s_host_ip_int}")
-
-    s_sshclient = SSHClient(user, s_host_ip_ext)
-
-    cmd = f"sudo snap install openstack --channel {config['channel']}\n"
-    out, rc = s_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-    if rc != 0:
-        utils.die("installing openstack snap failed, aborting")
-
-    cmd = "sunbeam prepare-node-script | grep -v newgrp | bash -x"
-    out, rc = s_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-    if rc != 0:
-        utils.die("running prepare-node-script failed, aborting")
-
-    utils.debug("Force new SSH connection to activate new groups on remote user")
-    s_sshclient.close()
-
-    cmd = f"sunbeam cluster add --format yaml --name {s_host_name_int}"
-    out, rc = p_sshclient.execute(
-        cmd, verbose=False, get_pty=False, combine_stderr=False, filtered=False)
-    utils.debug(f"execute return code is {rc}")
-    token = utils.yaml_safe_load(out)["token"]
-    utils.debug(f"Got token: {token}")
-    token_decoded = utils.b64decode(token).decode("utf-8")
-    utils.debug(f"Decoded token: {token_decoded}")
-
-    cmd = "sunbeam cluster join"
-    for role in node["roles"]:
-        cmd += f" --role {role}"
-    cmd += f" --token {token}"
-    out, rc = s_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-    if rc != 0:
-        utils.die("joining node failed, aborting")
-
-    cmd = "sunbeam cluster list"
-    out, rc = p_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-
-    s_sshclient.close()
-
-if control_count < 3:
-    utils.debug("Skipping 'resize' because there's not enough control nodes")
-else:
-    cmd = "sunbeam cluster resize"
-    out, rc = p_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-    if rc != 0:
-        utils.die("resizing cluster failed, aborting")
-
-cmd = "sunbeam configure --openrc ~/demo-openrc && echo >> ~/demo-openrc"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    # START OF HACK -- workaround for ceph size/min_size bug (temporary):
-    # in case configure fails and the node has storage role, try this workaround
-    # this is considering first node is storage (as mentioned, just a quick hack)
-    if "storage" in primary_node["roles"]:
-        utils.debug("Applying HACK for ceph size/min_size 3 issue, retrying configure")
-        cmd = """set -x
-            sudo ceph osd pool set glance min_size 1
-            sudo ceph osd pool set glance size 1 --yes-i-really-mean-it
-            sudo ceph osd pool set cinder-ceph min_size 1
-            sudo ceph osd pool set cinder-ceph size 1 --yes-i-really-mean-it
-        """
-        out, rc = p_sshclient.execute(
-            cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
+import watchdog
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--resume", action="store_true",
+                    help="skip the steps that completed in a previous (failed) run")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+
+    tracing.start_stage("deploy")
+
+    config = utils.read_config()
+    checkpoints = checkpoint.Checkpoint(config, resume=args.resume)
+
+    # order hosts to have control nodes first, then separete primary node from others
+    nodes = list(filter(lambda x: 'control' in x["roles"], config["nodes"]))
+    control_count = len(nodes)
+    nodes += list(filter(lambda x: 'control' not in x["roles"], config["nodes"]))
+    utils.debug(f"detected count of control nodes is {control_count}")
+    utils.debug(f"detected count of total nodes is {len(nodes)}")
+    utils.debug(f"complete list of nodes: {nodes}")
+    primary_node = nodes.pop(0)
+    utils.debug(f"selected primary node: {primary_node}")
+    utils.debug(f"secondary nodes list: {nodes}")
+
+    user = config["user"]
+    channel = config["channel"]
+    channelcp = config.get("channelcp", "")
+    p_host_name_int = primary_node["host-name-int"]
+    p_host_ip_ext = primary_node["host-ip-ext"]
+
+    def fetch_snap(sshclient, results):
+        # with the snap cache the snap is downloaded once here and pushed to all nodes
+        if config.get("snap_cache"):
+            return {"cached": snapcache.fetch("openstack", channel, config["snap_cache"])}
+        return {"cached": None}
+
+    def install_snap(sshclient, results):
+        if cached := results["fetch-snap"]["cached"]:
+            out, rc = snapcache.install(sshclient, "openstack", channel, cached)
+        else:
+            cmd = f"sudo snap install openstack --channel {channel}"
+            out, rc = sshclient.execute(cmd, **steps.EXECUTE_ARGS)
         utils.debug(f"execute return code is {rc}")
         if rc != 0:
-            utils.die("error applying hack for ceph size/min_size issue, aborting")
-    # and then try the configure one more time and update rc vaule
-    cmd = "sunbeam configure --openrc ~/demo-openrc && echo >> ~/demo-openrc"
-    out, rc = p_sshclient.execute(
-        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-    utils.debug(f"execute return code is {rc}")
-    if rc != 0:
-    # END OF HACK
-        utils.die("configuring demo project failed, aborting")
-
-cmd = "sunbeam openrc > ~/admin-openrc"
-out, rc = p_sshclient.execute(
-    cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
-utils.debug(f"execute return code is {rc}")
-if rc != 0:
-    utils.die("exporting admin credentials failed, aborting")
-
-p_sshclient.close()
+            utils.die("installing openstack snap failed, aborting")
+
+    def build_manifest(sshclient, results):
+        # The snap carries a few manifest override files that you can use
+        # to force candidate, edge, etc for the control plane (default is
+        # stable channel for CP even for non-stable openstack snaps)
+        overlay = manifests.node_overlay(sshclient, channelcp)
+        # Get a merged manifest using the snap one for defaults
+        manifest = manifests.merge(config["manifest"], overlay)
+        if problems := manifests.validate(manifest):
+            utils.die(f"invalid manifest: {problems}")
+
+        # Any other override that we may want to do on manifest can go here
+        # This will be valid for all profiles. It can go into the config
+        # file instead if it's for a specific profile.
+        # more doc at https://discourse.ubuntu.com/t/deployment-manifest/42672/5
+        #manifest.update({
+            #"juju": {
+            #    "bootstrap_args": [ "--debug" ],
+            #},
+            #"charms": {
+            #    "microk8s": { config: { containerd_env: "..."}, custom_registries: [ { url: "...", host: "...", } ], },
+            #    "keystone-k8s": { "channel": "2023.2/edge" },
+            #},
+        #})
+
+        manifest_dump = utils.yaml_dump(manifest)
+        utils.debug(f"Manifest contents are:\n{manifest_dump.rstrip()}")
+        sshclient.file_write("manifest.yaml", manifest_dump)
+        return {"manifest": manifest_dump}
+
+    def add_node(name):
+
+        def add(sshclient, results):
+            cmd = f"sunbeam cluster add --format yaml --name {name}"
+            out, rc = sshclient.execute(
+                cmd, verbose=False, get_pty=False, combine_stderr=False, filtered=False)
+            utils.debug(f"execute return code is {rc}")
+            token = utils.yaml_safe_load(out)["token"]
+            utils.debug(f"Got token: {token}")
+            token_decoded = utils.b64decode(token).decode("utf-8")
+            utils.debug(f"Decoded token: {token_decoded}")
+            # the token is single use, a resumed run only reuses it (skipping
+            # this step) when the node is already in the cluster
+            return {"token": token}
+
+        return add
+
+    def join_cmd(node):
+
+        def cmd(results):
+            join = "sunbeam cluster join"
+            for role in node["roles"]:
+                join += f" --role {role}"
+            return join + f" --token {results['add-' + node['host-name-int']]['token']}"
+
+        return cmd
+
+    # bootstrap and the like can go silent for an hour before they time out, get
+    # diagnostics meanwhile and give up early if things are not going to recover
+    deploy_watchdog = watchdog.Watchdog(abort=True)
+
+    runner = steps.StepRunner(user, checkpoints=checkpoints)
+
+    runner.add(steps.Step("fetch-snap", function=fetch_snap, resumable=False))
+
+    # every node gets installed and prepared as soon as possible, this does not
+    # depend on the cluster
+    for node in [primary_node] + nodes:
+        name = node["host-name-int"]
+        runner.add(steps.Step(
+            f"install-{name}", function=install_snap, host=node["host-ip-ext"],
+            deps=["fetch-snap"], inputs=channel, check="snap list openstack"))
+        runner.add(steps.Step(
+            f"prepare-{name}", "sunbeam prepare-node-script | grep -v newgrp | bash -x",
+            host=node["host-ip-ext"], deps=[f"install-{name}"],
+            error="running prepare-node-script failed, aborting",
+            check="id -nG | grep -qw snap_daemon",
+            # new SSH connection to activate new groups on remote user
+            reconnect=True))
+
+    ### Primary node / bootstrap
+
+    runner.add(steps.Step(
+        "manifest", function=build_manifest, host=p_host_ip_ext,
+        deps=[f"prepare-{p_host_name_int}"], resumable=False))
+
+    bootstrap_cmd = "sunbeam cluster bootstrap -m ~/manifest.yaml"
+    for role in primary_node["roles"]:
+        bootstrap_cmd += f" --role {role}"
+    runner.add(steps.Step(
+        "bootstrap", bootstrap_cmd, host=p_host_ip_ext, deps=["manifest"],
+        error="bootstrapping sunbeam failed, aborting",
+        retry_policy=retrypolicy.CLUSTER_POLICY, watchdog=deploy_watchdog,
+        inputs=lambda results: bootstrap_cmd + results["manifest"]["manifest"],
+        check="sunbeam cluster list"))
+
+    ### Other nodes
+
+    # add/join talk to the primary (cluster database), they go one node at a time
+    last_step = "bootstrap"
+    for node in nodes:
+        name = node["host-name-int"]
+        # the token is single use, it is only reused if the node did join with it
+        # (same check as join)
+        runner.add(steps.Step(
+            f"add-{name}", function=add_node(name), host=p_host_ip_ext, deps=[last_step],
+            check=f"sunbeam cluster list | grep -qw {name}"))
+        runner.add(steps.Step(
+            f"join-{name}", join_cmd(node), host=node["host-ip-ext"],
+            deps=[f"add-{name}", f"prepare-{name}"], error="joining node failed, aborting",
+            retry_policy=retrypolicy.ABORT_ONLY_POLICY, watchdog=deploy_watchdog,
+            inputs=node["roles"], check=f"sunbeam cluster list | grep -qw {name}"))
+        last_step = f"join-{name}"
+
+    runner.add(steps.Step(
+        "cluster-list", "sunbeam cluster list", host=p_host_ip_ext, deps=[last_step],
+        check_rc=False, resumable=False))
+    last_step = "cluster-list"
+
+    if control_count < 3:
+        utils.debug("Skipping 'resize' because there's not enough control nodes")
+    else:
+        runner.add(steps.Step(
+            "resize", "sunbeam cluster resize", host=p_host_ip_ext, deps=[last_step],
+            error="resizing cluster failed, aborting",
+            retry_policy=retrypolicy.DEFAULT_POLICY, watchdog=deploy_watchdog,
+            inputs=control_count, check="sunbeam cluster list"))
+        last_step = "resize"
+
+    # the ceph size/min_size workaround is only possible if the primary has storage,
+    # otherwise any failure still gets one more try
+    if "storage" in primary_node["roles"]:
+        configure_policy = retrypolicy.CEPH_CONFIGURE_POLICY
+    else:
+        configure_policy = retrypolicy.DEFAULT_POLICY.with_rules(retrypolicy.CONFIGURE_RULE)
+    runner.add(steps.Step(
+        "configure", "sunbeam configure --openrc ~/demo-openrc && echo >> ~/demo-openrc",
+        host=p_host_ip_ext, deps=[last_step], error="configuring demo project failed, aborting",
+        retry_policy=configure_policy, watchdog=deploy_watchdog, check="test -s ~/demo-openrc"))
+
+    runner.add(steps.Step(
+        "openrc", "sunbeam openrc > ~/admin-openrc", host=p_host_ip_ext, deps=["configure"],
+        error="exporting admin credentials failed, aborting",
+        check="test -s ~/admin-openrc"))
+
+    runner.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/bin/false
+
+"""
+Runs the same work on many hosts at once, with bounded concurrency, so that a
+job with N nodes does not take N times as long as a job with one node.
+
+Every worker thread sets its host name as log prefix, so that debug messages
+and verbose command output from different hosts stay readable when they get
+interleaved in the console.
+"""
+
+import concurrent.futures
+import time
+import utils
+from sshclient import SSHClient
+
+MAX_WORKERS = 8
+
+
+def run_item(function, item, label=str, cancel_event=None):
+    """Calls function(item) with the log prefix set to label(item) and returns a
+       dict with the 'result', 'error' (None if it went fine) and 'duration'.
+       A failure (or utils.die) is recorded instead of raised. With a
+       cancel_event, a failure sets it and the item is not even started if it
+       is already set"""
+    utils.set_log_prefix(label(item))
+    start = time.monotonic()
+    result = {"result": None, "error": None}
+    if cancel_event and cancel_event.is_set():
+        result.update(error="cancelled", duration=0)
+        utils.set_log_prefix(None)
+        return result
+    try:
+        result["result"] = function(item)
+    except SystemExit:
+        # utils.die() was called, the DIE message is already in the log
+        result["error"] = "died"
+    except Exception as e:
+        utils.debug(f"failed with exception {e!r}")
+        result["error"] = repr(e)
+    if result["error"] and cancel_event:
+        cancel_event.set()
+    result["duration"] = time.monotonic() - start
+    utils.set_log_prefix(None)
+    return result
+
+
+def parallel_map(function, items, max_workers=MAX_WORKERS, label=str, cancel_event=None):
+    """Calls function(item) for every item, at most max_workers at a time.
+       Returns a dict keyed by label(item) (in the same order as items) with
+       the result of run_item for each of them. A failure in one item does not
+       stop the others, unless a cancel_event is given (pass it along to
+       SSHClient.execute so that running commands stop too)"""
+    futures = start_parallel(function, items, max_workers=max_workers, label=label,
+                             cancel_event=cancel_event)
+    return {name: future.result() for name, future in futures.items()}
+
+
+def start_parallel(function, items, max_workers=MAX_WORKERS, label=str, cancel_event=None):
+    """Same as parallel_map but does not wait, returns a dict of label(item) ->
+       future (with the run_item result) so that the caller can do something
+       else meanwhile and wait for each item only when it needs it"""
+    workers = max(1, min(max_workers, len(items)))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {label(item): executor.submit(run_item, function, item, label, cancel_event)
+               for item in items}
+    # the executor goes away by itself once all submitted items are done
+    executor.shutdown(wait=False)
+    return futures
+
+
+def run_on_hosts(hosts, cmd, user, max_workers=MAX_WORKERS, **execute_args):
+    """Runs cmd on all hosts (a dict of host name -> address) at the same time.
+       cmd can be a string (same command everywhere) or a dict of host name
+       -> command. Any other argument is passed along to SSHClient.execute.
+       Returns a dict of host name -> {'out', 'rc', 'duration', 'error'}
+       (plus 'stderr' when capture_stderr is used)"""
+
+    def run(name):
+        host_cmd = cmd[name] if isinstance(cmd, dict) else cmd
+        sshclient = SSHClient(user, hosts[name])
+        try:
+            executed = sshclient.execute(host_cmd, **execute_args)
+        finally:
+            sshclient.close()
+        utils.debug(f"execute return code is {executed[1]}")
+        return executed
+
+    results = parallel_map(run, list(hosts), max_workers=max_workers)
+
+    host_results = {}
+    for name, result in results.items():
+        # execute returns (out, rc) or (out, rc, stderr) with capture_stderr
+        out, rc, *stderr = result["result"] or (None, None)
+        host_results[name] = {
+            "out": out,
+            "rc": rc,
+            "duration": result["duration"],
+            "error": result["error"],
+        }
+        if stderr:
+            host_results[name]["stderr"] = stderr[0]
+        utils.debug(f"[{name}] finished in {result['duration']:.1f}s rc={rc} "
+                    f"error={result['error']}")
+    return host_results
@@ -0,0 +1,103 @@
+#!/bin/false
+
+"""
+Splits the address ranges of a profile into slices, so that several clusters
+can be deployed at the same time on the same lab network without their IPs
+conflicting. Each build leases a slice and the substrate fills the manifest
+with it.
+
+Enabled with 'ip_allocation' in the profile:
+    ip_allocation: { slices: 2, nodes: "10.0.1.11-10.0.1.19" }
+- slices: in how many parts each range is split (how many clusters at once)
+- nodes: optional, addresses for the nodes when the substrate assigns them
+  (equinix), so hostnames and addresses differ between clusters too
+
+The ranges split are addons.metallb and external_network start/end (or range)
+of the manifest. bootstrap.management_cidr stays as it is for all clusters: it
+is not a pool of addresses but the network the nodes are on, sunbeam uses it to
+find the address of each node. The node addresses in it come from MAAS or from
+'nodes' above, and the metallb range in it is sliced, so what clusters use of
+that network does not overlap. A sliced cidr would leave nodes outside of it.
+
+Leases are kept in a state file shared by the jobs on the agent, they are
+released on destroy and expire after max_lease_hours (i.e. a build that was
+aborted before destroy).
+"""
+
+import ipaddress
+import os
+import time
+import utils
+
+STATE_FILE = "~/.cache/sunbeam-ci/ipalloc/leases.json"
+MAX_LEASE_HOURS = 24
+
+
+def split_range(value, slices, index):
+    """Part index of slices of each range in value ('a-b' or 'a-b,c-d,...')"""
+    parts = []
+    for item in str(value).split(","):
+        ends = [ipaddress.ip_address(x.strip()) for x in item.split("-")]
+        first, last = ends[0], ends[-1]
+        size = (int(last) - int(first) + 1) // slices
+        if size < 1:
+            utils.die(f"ip range {item} is too small for {slices} slices")
+        start = first + size * index
+        parts.append(f"{start}-{start + size - 1}")
+    return ",".join(parts)
+
+
+def acquire(profile_name, slices, owner, max_lease_hours=MAX_LEASE_HOURS):
+    """Leases a free slice (or the one owner already has) of the profile"""
+    now = time.time()
+    with utils.locked_json(os.path.expanduser(STATE_FILE)) as state:
+        leases = state.setdefault(profile_name, {})
+        for index, lease in leases.items():
+            if lease["owner"] == owner:
+                return int(index)
+        for index in range(slices):
+            lease = leases.get(str(index))
+            if lease and now - lease["since"] <= max_lease_hours * 3600:
+                continue
+            if lease:
+                utils.debug(f"IP-ALLOC: slice {index} was abandoned by {lease['owner']}")
+            leases[str(index)] = {"owner": owner, "since": now}
+            return index
+    utils.die(f"all {slices} ip slices of profile {profile_name} are in use, aborting")
+
+
+def release(profile_name, owner):
+    with utils.locked_json(os.path.expanduser(STATE_FILE)) as state:
+        leases = state.get(profile_name, {})
+        for index, lease in list(leases.items()):
+            if lease["owner"] == owner:
+                utils.debug(f"IP-ALLOC: releasing slice {index} of {profile_name}")
+                del leases[index]
+
+
+def allocate(profile_name, profile_data, manifest):
+    """Leases a slice for this build and fills the manifest ranges with it.
+       Returns the lease: {'slice': index, 'nodes': (first, last) or None},
+       or None when the profile does not use ip_allocation"""
+    if not (settings := profile_data.get("ip_allocation")):
+        return None
+    slices = settings["slices"]
+    index = acquire(profile_name, slices, utils.build_id(),
+                    settings.get("max_lease_hours", MAX_LEASE_HOURS))
+    utils.debug(f"IP-ALLOC: using slice {index} of {slices} for {profile_name}")
+
+    config = manifest["core"]["config"]
+    if metallb := config.get("addons", {}).get("metallb"):
+        config["addons"]["metallb"] = split_range(metallb, slices, index)
+    if external := config.get("external_network"):
+        if "start" in external and "end" in external:
+            start, end = split_range(f"{external['start']}-{external['end']}",
+                                     slices, index).split("-")
+            external["start"], external["end"] = start, end
+        if "range" in external:
+            external["range"] = split_range(external["range"], slices, index)
+
+    nodes = None
+    if "nodes" in settings:
+        nodes = tuple(split_range(settings["nodes"], slices, index).split("-"))
+    return {"slice": index, "nodes": nodes}
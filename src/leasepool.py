@@ -0,0 +1,238 @@
+#!/bin/false
+
+"""
+Keeps provisioned substrates warm between builds instead of destroying them,
+so that a build that wants the same profile and number of hosts skips terraform
+apply (MAAS commissioning/deploy, equinix provisioning) altogether.
+
+Enabled with 'lease_pool' in the profile (maas and equinix substrates):
+    lease_pool: { size: 2, max_leases: 20, max_lease_hours: 24 }
+- size: how many free substrates of a profile/topology are kept
+- max_leases: after that many builds the nodes are destroyed (fresh install)
+- max_lease_hours: a lease older than that is considered abandoned (i.e. an
+  aborted job that never ran destroy) and the substrate can be handed out again
+
+On destroy the nodes of the build are reset in place (snaps removed, juju and
+sunbeam state deleted, ceph disks wiped) and returned to the pool. On build a
+free substrate is health checked first, one that fails (or fails to reset) is
+recycled with terraform destroy. The pool lives in a state file protected by a
+file lock, shared by all jobs on the agent. Each entry keeps a copy of its
+terraform state, so that any workspace can destroy it later.
+"""
+
+import copy
+import os
+import shutil
+import time
+import fanout
+import ipalloc
+import utils
+
+POOL_DIR = "~/.cache/sunbeam-ci/leasepool"
+STATE_FILE = "pool.json"
+
+# entry states
+FREE = "free"
+LEASED = "leased"
+
+RESET_CMD = """set -x
+    for snap in openstack openstack-hypervisor microk8s microceph microovn juju; do
+        sudo snap remove --purge $snap || :
+    done
+    rm -rf ~/.local/share/juju ~/.local/share/openstack ~/manifest.yaml \
+        ~/demo-openrc ~/admin-openrc
+    sudo journalctl --vacuum-size=10M
+    set -e
+    for disk in {disks}; do
+        test -b $disk || continue
+        sudo wipefs -af $disk
+        sudo dd if=/dev/zero of=$disk bs=1M count=100 oflag=direct status=none
+    done
+    """
+
+HEALTH_CMD = """set -xe
+    if snap list openstack microk8s microceph juju 2>/dev/null | grep -q .; then exit 1; fi
+    test ! -e ~/.local/share/juju
+    for disk in {disks}; do test -b $disk; done
+    test $(df --output=avail -k / | tail -1) -gt 10485760
+    """
+
+
+def get_settings(lease_pool):
+    if lease_pool is True:
+        lease_pool = {}
+    return {
+        "size": lease_pool.get("size", 1),
+        "max_leases": lease_pool.get("max_leases", 20),
+        "max_lease_hours": lease_pool.get("max_lease_hours", 24),
+    }
+
+
+class LeasePool:
+
+    def __init__(self, pool_dir=POOL_DIR):
+        self.pool_dir = os.path.expanduser(pool_dir)
+        os.makedirs(self.pool_dir, exist_ok=True)
+
+
+    def locked(self):
+        """The pool state (a dict of entry id -> entry), see utils.locked_json"""
+        return utils.locked_json(f"{self.pool_dir}/{STATE_FILE}")
+
+
+    def tfstate_file(self, entry_id):
+        return f"{self.pool_dir}/{entry_id}.tfstate"
+
+
+    def acquire(self, profile, hosts_qty, owner, max_lease_hours=24):
+        """Leases a free (or abandoned) entry of profile with hosts_qty hosts to
+           owner, returns it or None"""
+        now = time.time()
+        with self.locked() as state:
+            for entry in state.values():
+                if entry["profile"] != profile or entry["hosts_qty"] != hosts_qty:
+                    continue
+                abandoned = entry["state"] == LEASED and \
+                    now - entry["since"] > max_lease_hours * 3600
+                if entry["state"] == FREE or abandoned:
+                    if abandoned:
+                        utils.debug(f"LEASE: {entry['id']} was abandoned by {entry['owner']}")
+                    entry.update(state=LEASED, owner=owner, since=now,
+                                 leases=entry["leases"] + 1)
+                    return dict(entry)
+        return None
+
+
+    def register(self, profile, hosts_qty, owner, config, tfstate):
+        """Adds a newly built substrate to the pool, leased to owner"""
+        with self.locked() as state:
+            number = 1
+            while f"{profile}-{number}" in state:
+                number += 1
+            entry_id = f"{profile}-{number}"
+            shutil.copyfile(tfstate, self.tfstate_file(entry_id))
+            state[entry_id] = {
+                "id": entry_id, "profile": profile, "hosts_qty": hosts_qty,
+                "state": LEASED, "owner": owner, "since": time.time(), "leases": 1,
+                "config": config,
+            }
+            return dict(state[entry_id])
+
+
+    def lease_of(self, owner):
+        with self.locked() as state:
+            for entry in state.values():
+                if entry["state"] == LEASED and entry["owner"] == owner:
+                    return dict(entry)
+        return None
+
+
+    def free_count(self, profile, hosts_qty):
+        with self.locked() as state:
+            return sum(1 for entry in state.values() if entry["profile"] == profile
+                       and entry["hosts_qty"] == hosts_qty and entry["state"] == FREE)
+
+
+    def release(self, entry_id):
+        with self.locked() as state:
+            state[entry_id].update(state=FREE, owner=None, since=time.time())
+
+
+    def remove(self, entry_id):
+        with self.locked() as state:
+            state.pop(entry_id, None)
+        if os.path.isfile(self.tfstate_file(entry_id)):
+            os.remove(self.tfstate_file(entry_id))
+
+
+def run_on_nodes(config, cmd):
+    """Runs cmd on all nodes of a substrate config, True if it worked on all"""
+    hosts = {node["host-name-int"]: node["host-ip-ext"] for node in config["nodes"]}
+    results = fanout.run_on_hosts(
+        hosts, cmd, config["user"],
+        verbose=True, get_pty=False, combine_stderr=True, filtered=False)
+    return all(result["rc"] == 0 and not result["error"] for result in results.values())
+
+
+def tfstate(substrate_module):
+    return f"{substrate_module.tf.directory}/terraform.tfstate"
+
+
+def restore_tfstate(pool, entry, substrate_module):
+    """Puts the terraform state of entry in the workspace, so that destroy there
+       destroys its nodes"""
+    os.makedirs(substrate_module.tf.directory, exist_ok=True)
+    shutil.copyfile(pool.tfstate_file(entry["id"]), tfstate(substrate_module))
+
+
+def recycle(pool, entry, substrate_module, jenkins_config, jenkins_creds, profile_data):
+    utils.debug(f"LEASE: recycling {entry['id']}")
+    restore_tfstate(pool, entry, substrate_module)
+    substrate_module.tf.init()
+    substrate_module.execute(jenkins_config, jenkins_creds, profile_data, "destroy")
+    pool.remove(entry["id"])
+
+
+def execute(substrate_module, jenkins_config, jenkins_creds, profile_name, profile_data, action):
+    """Same as substrate_module.execute, going through the pool"""
+    pool = LeasePool()
+    settings = get_settings(profile_data["lease_pool"])
+    hosts_qty = len(jenkins_config["roles"])
+    owner = utils.build_id()
+    disks = profile_data.get("ceph_disks", "/dev/sdb")
+
+    if action == "build":
+        while entry := pool.acquire(profile_name, hosts_qty, owner,
+                                    settings["max_lease_hours"]):
+            utils.debug(f"LEASE: got {entry['id']} (lease #{entry['leases']}), health check")
+            config = entry["config"]
+            if run_on_nodes(config, HEALTH_CMD.format(disks=disks)):
+                restore_tfstate(pool, entry, substrate_module)
+                # same nodes, what changes from build to build comes from jenkins
+                # and the profile (the substrate only adds the ceph disks)
+                config["channel"] = jenkins_config["channel"]
+                config["channelcp"] = jenkins_config["channelcp"]
+                for node, roles in zip(config["nodes"], jenkins_config["roles"]):
+                    node["roles"] = roles.split(",")
+                microceph_config = config["manifest"]["core"]["config"].get("microceph_config")
+                config["manifest"] = copy.deepcopy(profile_data["manifest"])
+                if microceph_config:
+                    config["manifest"]["core"]["config"]["microceph_config"] = microceph_config
+                for key in ("snap_cache", "package_cache"):
+                    config.pop(key, None)
+                    if key in profile_data:
+                        config[key] = profile_data[key]
+                # node addresses stay the ones of the build that provisioned them
+                config.pop("ip_slice", None)
+                if ip_lease := ipalloc.allocate(profile_name, profile_data, config["manifest"]):
+                    config["ip_slice"] = ip_lease["slice"]
+                config["lease"] = entry["id"]
+                utils.write_config(config)
+                return
+            recycle(pool, entry, substrate_module, jenkins_config, jenkins_creds, profile_data)
+
+        utils.debug(f"LEASE: no free substrate for {profile_name} with {hosts_qty} hosts")
+        substrate_module.execute(jenkins_config, jenkins_creds, profile_data, "build")
+        config = utils.read_config()
+        entry = pool.register(profile_name, hosts_qty, owner, config, tfstate(substrate_module))
+        config["lease"] = entry["id"]
+        utils.write_config(config)
+
+    elif action == "destroy":
+        if not (entry := pool.lease_of(owner)):
+            substrate_module.execute(jenkins_config, jenkins_creds, profile_data, "destroy")
+            return
+        if entry["leases"] >= settings["max_leases"] or \
+                pool.free_count(profile_name, hosts_qty) >= settings["size"]:
+            recycle(pool, entry, substrate_module, jenkins_config, jenkins_creds, profile_data)
+        elif run_on_nodes(entry["config"], RESET_CMD.format(disks=disks)):
+            utils.debug(f"LEASE: {entry['id']} reset, back to the pool")
+            pool.release(entry["id"])
+            # the pool owns the nodes now, a later apply in this workspace must
+            # not touch them
+            os.remove(tfstate(substrate_module))
+        else:
+            recycle(pool, entry, substrate_module, jenkins_config, jenkins_creds, profile_data)
+
+    else:
+        utils.die("Invalid action parameter")
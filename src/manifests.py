@@ -0,0 +1,139 @@
+#!/bin/false
+
+"""
+Builds the deployment manifest: the profile manifest merged on top of the
+overlay the openstack snap carries for the control plane channel (channelcp).
+
+Overlays are cached locally by snap revision and channelcp, so they are read
+from the node (or from the snap file) only once per revision. Since the snap
+can also be fetched on the agent (see snapcache.py), the merged manifest can be
+built, validated and diffed before any substrate exists (see build_manifest.py).
+"""
+
+import ipaddress
+import os
+import subprocess
+import snapcache
+import utils
+
+OVERLAY_CACHE_DIR = "~/.cache/sunbeam-ci/manifests"
+
+# the snap defaults to stable channels for the control plane, no overlay needed
+CHANNELCP_OVERLAYS = ("candidate", "beta", "edge")
+
+
+def check_channelcp(channelcp):
+    if channelcp != "stable" and channelcp not in CHANNELCP_OVERLAYS:
+        utils.die("Missing or invalid 'channelcp' value")
+
+
+def overlay_path(channelcp):
+    return f"/snap/openstack/current/etc/manifests/{channelcp}.yml"
+
+
+def cache_file(revision, channelcp):
+    return f"{os.path.expanduser(OVERLAY_CACHE_DIR)}/openstack_{revision}_{channelcp}.yml"
+
+
+def read_cache(revision, channelcp):
+    if revision and os.path.isfile(filename := cache_file(revision, channelcp)):
+        utils.debug(f"MANIFEST: using cached overlay for revision {revision} {channelcp}")
+        return utils.read_file(filename)
+    return None
+
+
+def write_cache(revision, channelcp, content):
+    if revision:
+        os.makedirs(os.path.dirname(cache_file(revision, channelcp)), exist_ok=True)
+        utils.write_file(content, cache_file(revision, channelcp))
+
+
+def node_overlay(sshclient, channelcp):
+    """The overlay of the snap installed on the node behind sshclient"""
+    check_channelcp(channelcp)
+    if channelcp == "stable":
+        return {}
+    out, rc = sshclient.execute("snap list openstack | awk 'NR == 2 { print $3 }'")
+    revision = out.strip() if rc == 0 else None
+    if (content := read_cache(revision, channelcp)) is None:
+        content = sshclient.file_read(overlay_path(channelcp))
+        write_cache(revision, channelcp, content)
+    return utils.yaml_safe_load(content) or {}
+
+
+def offline_overlay(channel, channelcp, snap_cache=True):
+    """The overlay of the snap currently in channel, without any node: from the
+       cache or else from the snap file itself (downloaded to the snap cache)"""
+    check_channelcp(channelcp)
+    if channelcp == "stable":
+        return {}
+    revision = snapcache.store_revision("openstack", channel)
+    if (content := read_cache(revision, channelcp)) is None:
+        if not (cached := snapcache.fetch("openstack", channel, snap_cache)):
+            utils.die(f"could not download openstack snap from {channel}")
+        snap_file = cached[0]
+        revision = os.path.basename(snap_file)[len("openstack_"):-len(".snap")]
+        # same path inside the snap file, relative to its root
+        path_in_snap = overlay_path(channelcp)[len("/snap/openstack/current/"):]
+        result = subprocess.run(["unsquashfs", "-cat", snap_file, path_in_snap],
+                                capture_output=True, text=True, check=False)
+        if result.returncode != 0:
+            utils.die(f"could not read manifest overlay from {snap_file}: {result.stderr}")
+        content = result.stdout
+        write_cache(revision, channelcp, content)
+    return utils.yaml_safe_load(content) or {}
+
+
+def merge(manifest, overlay):
+    """The profile manifest on top of the snap overlay (used for defaults)"""
+    if not overlay:
+        return manifest
+    return utils.merge_dicts(overlay, manifest)
+
+
+def validate(manifest):
+    """Sanity checks that can be done without a deployment, returns a list of
+       problems (empty if none)"""
+    problems = []
+    config = (manifest or {}).get("core", {}).get("config", {})
+    if not config:
+        return ["missing core.config"]
+
+    def network(path, value):
+        try:
+            return ipaddress.ip_network(value)
+        except ValueError:
+            problems.append(f"{path}: invalid network '{value}'")
+            return None
+
+    def address(path, value):
+        try:
+            return ipaddress.ip_address(value)
+        except ValueError:
+            problems.append(f"{path}: invalid address '{value}'")
+            return None
+
+    management = None
+    # not there for maas deployments, where maas knows the networks
+    if cidr := config.get("bootstrap", {}).get("management_cidr"):
+        # can be a comma separated list
+        management = [network("bootstrap.management_cidr", x.strip()) for x in cidr.split(",")]
+
+    def ip_range(path, value, networks):
+        for item in str(value).split(","):
+            ends = [address(path, x.strip()) for x in item.split("-")]
+            if networks and all(networks) and all(ends):
+                for ip in ends:
+                    if not any(ip in net for net in networks):
+                        problems.append(
+                            f"{path}: {ip} is outside of {', '.join(map(str, networks))}")
+
+    if metallb := config.get("addons", {}).get("metallb"):
+        ip_range("addons.metallb", metallb, management)
+
+    if external := config.get("external_network"):
+        cidr = network("external_network.cidr", external.get("cidr", ""))
+        for key in ("gateway", "start", "end", "range"):
+            if key in external:
+                ip_range(f"external_network.{key}", external[key], [cidr])
+    return problems
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+# This script expands a test matrix (see matrix.yaml.example) into builds, each
+# one with the JENKINS_JSON_CONFIG payload and credential it needs, and plans
+# when each of them runs so that the whole matrix finishes as soon as possible:
+# - longest builds first (their duration comes from the history of the job in
+#   Jenkins, or default_duration)
+# - never more hosts per substrate than max_hosts, never more builds per
+#   credential than its quota
+# - a build that can take the nodes of a finished one with the same substrate
+#   and number of hosts (lease pool) goes before the others
+#
+# The plan is a list of lanes, each lane is run in sequence and all lanes at the
+# same time (see jenkins/Jenkinsfile-buildall-matrix). A lane is one slot of the
+# quota of a credential, so the credential quotas hold even when builds take
+# longer or shorter than estimated. max_hosts only holds in the plan: nothing
+# enforces it while the builds run, and builds that overrun their estimates can
+# overlap with the next ones of other lanes on the same substrate. With
+# --dry-run it prints the planned timeline and estimated makespan instead.
+
+import argparse
+import glob
+import itertools
+import json
+import re
+import statistics
+import sys
+import utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-m", "--matrix", default="matrix.yaml", help="matrix definition")
+parser.add_argument("-o", "--output", help="write the plan (JSON) to this file instead of stdout")
+parser.add_argument("-n", "--dry-run", action="store_true",
+                    help="print the planned timeline and makespan")
+# same place build_description.py looks for builds, relative to the workspace
+parser.add_argument("--jobs-dir", default="../../jobs", help="Jenkins jobs dir, for durations")
+args = parser.parse_args()
+
+# how many of the last builds of a job are used for its estimated duration
+HISTORY_BUILDS = 5
+
+
+def expand(matrix):
+    """All combinations of the matrix as builds (dicts), minus the excluded"""
+    builds = []
+    for substrate, topology, storage, channels in itertools.product(
+            matrix["substrates"], matrix["topologies"], matrix["storage"], matrix["channels"]):
+        combination = {"substrate": substrate, "topology": topology, "storage": storage,
+                       "channel": channels["channel"].replace("/", "-"),
+                       "channelcp": channels["channelcp"]}
+        if any(all(combination.get(key) == value for key, value in exclude.items())
+               for exclude in matrix.get("exclude", [])):
+            continue
+        hosts = matrix["topologies"][topology]["hosts"]
+        control = matrix["topologies"][topology]["control"]
+        extra = ",storage" if storage == "storage" else ""
+        roles = [("control,compute" if i < control else "compute") + extra for i in range(hosts)]
+        builds.append({
+            "job": matrix.get("job", "sunbeam-{substrate}-{topology}-{storage}-{channel}")
+                .format(**combination),
+            "substrate": substrate,
+            "hosts": hosts,
+            "config": {
+                "profile": matrix["substrates"][substrate]["profile"],
+                "channel": channels["channel"],
+                "channelcp": channels["channelcp"],
+                "roles": roles,
+            },
+        })
+    return builds
+
+
+def past_duration(job):
+    """Median duration (minutes) of the last builds of job in Jenkins, or None"""
+    durations = []
+    builds = glob.glob(f"{args.jobs_dir}/{job}/builds/*/build.xml")
+    builds.sort(key=lambda x: int(x.split("/")[-2]) if x.split("/")[-2].isdigit() else 0)
+    for build_xml in builds[-HISTORY_BUILDS:]:
+        if match := re.search(r"<duration>(\d+)</duration>", utils.read_file(build_xml)):
+            durations.append(int(match.group(1)) / 60000)
+    return statistics.median(durations) if durations else None
+
+
+def schedule(builds, substrates):
+    """Simulates the run of all builds, sets 'start', 'end', 'lane', 'credential'
+       and 'reused' in each of them. Returns the lanes (lists of builds)"""
+    pending = list(builds)
+    running = []
+    used_hosts = {name: 0 for name in substrates}
+    used_credentials = {cred: 0 for sub in substrates.values() for cred in sub["credentials"]}
+    warm = {} # (substrate, hosts) -> finished builds whose nodes can be reused
+    lanes = {} # (credential, slot) -> builds
+    now = 0
+
+    def credential_for(build):
+        substrate = substrates[build["substrate"]]
+        if used_hosts[build["substrate"]] + build["hosts"] > substrate["max_hosts"]:
+            return None
+        free = [cred for cred, quota in substrate["credentials"].items()
+                if used_credentials[cred] < quota]
+        return min(free, key=lambda x: used_credentials[x]) if free else None
+
+    while pending:
+        # builds that can reuse nodes first, then the longest ones
+        for build in sorted(pending, key=lambda x: (
+                not warm.get((x["substrate"], x["hosts"])), -x["estimate"])):
+            if not (credential := credential_for(build)):
+                continue
+            key = (build["substrate"], build["hosts"])
+            reuse = substrates[build["substrate"]].get("reuse_minutes", 0)
+            build["reused"] = bool(warm.get(key) and reuse)
+            if build["reused"]:
+                warm[key] -= 1
+            build.update(credential=credential, start=now,
+                         end=now + max(build["estimate"] - (reuse if build["reused"] else 0), 1))
+            used_hosts[build["substrate"]] += build["hosts"]
+            used_credentials[credential] += 1
+            slot = next(i for i in itertools.count() if not lanes.get((credential, i))
+                        or lanes[(credential, i)][-1]["end"] <= now)
+            lanes.setdefault((credential, slot), []).append(build)
+            running.append(build)
+            pending.remove(build)
+        if not running:
+            utils.die(f"these builds never fit in their substrate: {[x['job'] for x in pending]}")
+        now = min(x["end"] for x in running)
+        for build in [x for x in running if x["end"] == now]:
+            running.remove(build)
+            used_hosts[build["substrate"]] -= build["hosts"]
+            used_credentials[build["credential"]] -= 1
+            key = (build["substrate"], build["hosts"])
+            warm[key] = warm.get(key, 0) + 1
+    lanes = list(lanes.values())
+    for index, lane in enumerate(lanes):
+        for build in lane:
+            build["lane"] = index
+    return lanes
+
+
+def minutes(value):
+    return f"{int(value) // 60}:{int(value) % 60:02d}"
+
+
+matrix = utils.yaml_safe_load(utils.read_file(args.matrix))
+builds = expand(matrix)
+if not builds:
+    utils.die("the matrix has no builds")
+
+for build in builds:
+    history = past_duration(build["job"])
+    build["estimate"] = history or matrix.get("default_duration", 120)
+    build["history"] = history is not None
+
+lanes = schedule(builds, matrix["substrates"])
+makespan = max(build["end"] for build in builds)
+
+if args.dry_run:
+    for build in sorted(builds, key=lambda x: (x["start"], x["lane"])):
+        print(f"{minutes(build['start']):>6} - {minutes(build['end']):>6}  "
+              f"lane {build['lane'] + 1:<3} {build['credential']:<24} {build['job']}"
+              f"{'  (reused nodes)' if build['reused'] else ''}"
+              f"{'' if build['history'] else '  (no history)'}")
+    serial = sum(build["end"] - build["start"] for build in builds)
+    print(f"{len(builds)} builds in {len(lanes)} lanes, estimated makespan {minutes(makespan)} "
+          f"(one at a time: {minutes(serial)})")
+    sys.exit(0)
+
+plan = {
+    "makespan": makespan,
+    "lanes": [[{
+        "job": build["job"],
+        "credential": build["credential"],
+        # as Jenkins takes it, in the JSONConfig parameter
+        "config": json.dumps(build["config"]),
+        "estimate": build["estimate"],
+    } for build in lane] for lane in lanes],
+}
+if args.output:
+    utils.write_file(json.dumps(plan, indent=2), args.output)
+else:
+    print(json.dumps(plan, indent=2))
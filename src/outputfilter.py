@@ -0,0 +1,141 @@
+#!/bin/false
+
+"""
+Filters the noise out of the console output of remote commands (ANSI codes,
+spinning wheels, progress percentages, etc.) so that the Jenkins log is readable.
+
+All rules are compiled once when the filter is created and the substitutions
+are combined in a single regex pass, which matters because a bootstrap prints
+spinner updates thousands of times per second. A filter can be shared by many
+commands (and threads), the per-command state lives in the stream objects.
+"""
+
+import re
+
+
+# (regex, replacement), all of them combined into a single regex pass
+SUBSTITUTIONS = [
+    # ANSI Codes
+    (r"\x1b\[\??[0-9;]*[hlmAGKHF]", ""),
+    # The spinning wheel at the status lines
+    (r"[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏] *", "> "),
+]
+
+# (prefixes, regex, replacement), the regex is only tried on lines that start
+# with one of the prefixes, which is a lot cheaper than running it on every line
+LINE_REWRITES = [
+    # the spinning wheel + download percentage at snap install
+    (
+        ("Ensure prerequisites", "Download snap", "Fetch and check assertions",
+         "Mount snap", "Setup snap", "Copy snap", "Connect ", "Run health check",
+         "Run install hook", "Start snap", "Run service command",
+         "Run configure hook", "Automatically connect eligible plugs"),
+        r"^((Ensure prerequisites|Download snap|Fetch and check assertions|"
+        r"Mount snap|Setup snap|Copy snap|Connect .* to|Run health check|"
+        r"Run install hook|Start snap|Run service command|"
+        r"Run configure hook|Automatically connect eligible plugs).*?)"
+        r" +([-\\|/]|[0-9]+% .*)$",
+        r"\1",
+    ),
+]
+
+# lines containing any of these are dropped entirely
+DROP_SUBSTRINGS = [
+    # Apt "Reading database" verboseness
+    "(Reading database ...",
+]
+
+# status lines that get their result printed in a separate line, they are held
+# back and joined with the line that comes after them
+JOIN_NEXT = [
+    r"> Deploying OpenStack Control Plane to Kubernetes \(this may take a while\)",
+    r"> Resizing OpenStack Control Plane to match appropriate topology",
+    r"> Applying local hypervisor settings \.\.\. setting hypervisor configuration for",
+    r"> No sunbeam key found in OpenStack\. Creating SSH key at",
+    r"> Enabling OpenStack telemetry application \.\.\. waiting for services to come",
+    r"> Enabling OpenStack observability application \.\.\. waiting for services to come",
+    r"> Enabling OpenStack validation application ... waiting for services to come",
+    r"> Applying hypervisor settings ... setting hypervisor configuration for",
+    r"> Copying .* from tempest",
+]
+
+
+class OutputFilter:
+
+    def __init__(self, substitutions=SUBSTITUTIONS, line_rewrites=LINE_REWRITES,
+                 drop_substrings=DROP_SUBSTRINGS, join_next=JOIN_NEXT):
+        # each substitution gets a named group so that we know which one matched
+        self.replacements = {}
+        alternatives = []
+        for n, (regex, replacement) in enumerate(substitutions):
+            self.replacements[f"s{n}"] = replacement
+            alternatives.append(f"(?P<s{n}>{regex})")
+        self.substitute = re.compile("|".join(alternatives)).sub if alternatives else None
+        self.line_rewrites = [
+            (tuple(prefixes), re.compile(regex), replacement)
+            for prefixes, regex, replacement in line_rewrites]
+        self.drop_substrings = tuple(drop_substrings)
+        self.join_next = re.compile("|".join(join_next)) if join_next else None
+
+
+    def __replace(self, match):
+        return self.replacements[match.lastgroup]
+
+
+    def strip_garbage(self, line):
+        # Spaces at the end
+        line = line.rstrip(" ")
+        if self.substitute:
+            line = self.substitute(self.__replace, line)
+        for prefixes, regex, replacement in self.line_rewrites:
+            if line.startswith(prefixes):
+                line = regex.sub(replacement, line)
+        for substring in self.drop_substrings:
+            if substring in line:
+                return ""
+        return line
+
+
+    def stream(self):
+        """Returns a new stream to filter the output of one command"""
+        return FilterStream(self)
+
+
+class FilterStream:
+    """Keeps the state of one command output: the last line shown (to avoid
+       repeating spinner updates) and a status line waiting for its second half"""
+
+    def __init__(self, output_filter):
+        self.output_filter = output_filter
+        self.last_line = None
+        self.delayed_line = None
+
+
+    def feed(self, lineraw):
+        """Filters one raw line, returns the filtered text (to keep) and the list
+           of lines that are new and should be shown on console"""
+        # we may have received lots of lines with \r separator in one raw line
+        # output may be delayed until a \n comes, but then all lines are shown
+        lines_buffer = []
+        new_lines = []
+        join_next = self.output_filter.join_next
+        for line in lineraw.rstrip().split("\r"):
+            line = self.output_filter.strip_garbage(line)
+            # some lines get empty after removing all garbage
+            # this ends up removing originally empty lines too
+            if not line:
+                continue
+            if self.delayed_line:
+                line = f"{self.delayed_line} {line}"
+                self.delayed_line = None
+            elif join_next and join_next.search(line):
+                self.delayed_line = line
+                continue
+            if line != self.last_line:
+                new_lines.append(line)
+                self.last_line = line
+            lines_buffer.append(f"{line}\n")
+        return "".join(lines_buffer), new_lines
+
+
+DEFAULT_FILTER = OutputFilter()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3 -u
+
+# This script runs the stages of a build (substrate build, deploy, test, artifacts
+# collection...) one after the other in this same process, instead of one
+# process per stage: config.yaml is parsed once, the ssh connections opened by
+# one stage are reused by the next ones (see sshclient.TransportPool) and each
+# stage still gets its own trace file. Every stage can still be run on its own
+# with its script, as the Jenkinsfile does.
+#
+# Failures are handled as in the Jenkinsfile: a failed build or deploy skips the
+# tests, a failed test makes the result unstable (exit code 2), collect and
+# the stages after it always run.
+
+import argparse
+import os
+import sys
+import time
+import build_description
+import collect_artifacts
+import deploy
+import manage_substrate
+import test_sunbeam
+import tracing
+import utils
+
+# name -> (function(args), runs even after a failure, failure only makes it unstable)
+STAGES = {
+    "build": (lambda args: manage_substrate.main(["build"]), False, False),
+    "deploy": (lambda args: deploy.main(["--resume"] if args.resume else []), False, False),
+    "test": (lambda args: test_sunbeam.main([]), False, True),
+    "collect": (lambda args: collect_artifacts.main([]), True, True),
+    # needs to run in Jenkins, after the artifacts were archived
+    "describe": (lambda args: build_description.main(
+        ["-j", os.environ["JOB_NAME"], "-b", os.environ["BUILD_NUMBER"]]), True, True),
+    "destroy": (lambda args: manage_substrate.main(["destroy"]), True, False),
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--stages", default="build,deploy,test,collect",
+                    help=f"comma separated list of stages from {', '.join(STAGES)}")
+parser.add_argument("--destroy", action="store_true", help="destroy the substrate at the end")
+parser.add_argument("--resume", action="store_true",
+                    help="resume the deploy from the step that failed in a previous run")
+
+
+def run_stage(name, args):
+    utils.debug(f"PIPELINE: starting stage '{name}'")
+    start = time.monotonic()
+    try:
+        rc = STAGES[name][0](args) or 0
+    except SystemExit as e:
+        # utils.die() was called, the DIE message is already in the log
+        rc = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        utils.debug(f"PIPELINE: stage '{name}' failed with exception {e!r}")
+        rc = 1
+    tracing.end_stage()
+    utils.set_log_prefix(None)
+    utils.debug(f"PIPELINE: stage '{name}' finished with rc={rc} "
+                f"in {time.monotonic() - start:.1f}s")
+    return rc
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    stages = args.stages.split(",") + (["destroy"] if args.destroy else [])
+    if unknown := [name for name in stages if name not in STAGES]:
+        utils.die(f"Invalid stages {unknown}, valid ones are {list(STAGES)}")
+
+    failed = unstable = False
+    results = {}
+    for name in stages:
+        _, always, only_unstable = STAGES[name]
+        if failed and not always:
+            results[name] = "skipped"
+            continue
+        rc = run_stage(name, args)
+        if rc == 0:
+            results[name] = "ok"
+        elif only_unstable:
+            results[name] = "unstable"
+            unstable = True
+        else:
+            results[name] = "failed"
+            failed = True
+
+    utils.debug("PIPELINE: " + ", ".join(f"{name}={result}" for name, result in results.items()))
+    if failed:
+        return 1
+    return 2 if unstable else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
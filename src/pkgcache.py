@@ -0,0 +1,265 @@
+#!/bin/false
+
+"""
+Package cache for substrate preparation, so that the hosts of a build do not all
+download the same debs over the WAN on every build.
+
+Set 'package_cache' in the profile, either pointing to existing proxies:
+    package_cache: { apt_proxy: "http://apt-cacher.lab:3142", snap_proxy: "http://squid.lab:3128" }
+or to start a small caching apt proxy on the agent while hosts are configured
+(address is how the hosts reach the agent, the proxy only listens there):
+    package_cache: { local: True, address: "10.0.1.1", port: 3142, mirrors: [ "mirror.lab" ] }
+
+The local proxy only caches what never changes for a given URL (.deb files and
+by-hash indexes), everything else is passed through. It only goes to the Ubuntu
+archives and the hosts in 'mirrors', anything else is refused so that it can not
+be used to reach the agent's network (Jenkins on localhost included). When the
+port is taken (another build on the agent) it listens on a free one instead.
+It does not tunnel https, snaps are covered by the snap cache (see
+snapcache.py) or an external snap_proxy.
+"""
+
+import errno
+import hashlib
+import http.server
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import utils
+
+CACHE_DIR = "~/.cache/sunbeam-ci/apt"
+MAX_SIZE_GB = 20
+DEFAULT_PORT = 3142
+APT_CONF_FILE = "/etc/apt/apt.conf.d/90sunbeam-ci-proxy"
+STATS_FILE = "artifacts/package-cache.yaml"
+CACHEABLE_SUFFIXES = (".deb", ".udeb", ".ddeb")
+CHUNK_SIZE = 65536
+# upstream hosts always allowed, the profile adds its mirrors
+ARCHIVE_HOSTS = ("archive.ubuntu.com", "security.ubuntu.com", "ports.ubuntu.com")
+
+
+def is_cacheable(url):
+    return url.endswith(CACHEABLE_SUFFIXES) or "/by-hash/" in url
+
+
+def is_allowed(url, hosts):
+    """True if url is plain http to one of hosts (or a country mirror of the
+       Ubuntu archive) on the default port"""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return False
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "http" or port not in (None, 80):
+        return False
+    return host in hosts or host.endswith(".archive.ubuntu.com")
+
+
+class PackageCache:
+    """A caching HTTP proxy for apt running in background threads"""
+
+    def __init__(self, address, port=DEFAULT_PORT, cache_dir=CACHE_DIR,
+                 max_size_gb=MAX_SIZE_GB, mirrors=()):
+        self.address = address
+        self.port = port
+        self.hosts = set(ARCHIVE_HOSTS) | {host.lower() for host in mirrors}
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "passthrough": 0, "errors": 0,
+                      "bytes_from_cache": 0, "bytes_downloaded": 0}
+        self.server = None
+
+
+    def count(self, **increments):
+        with self.lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+
+    def cache_file(self, url):
+        return f"{self.cache_dir}/{hashlib.sha256(url.encode('utf-8')).hexdigest()}"
+
+
+    def start(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                # one line per package would flood the build log
+                pass
+
+            def do_GET(self):
+                cache.handle(self)
+
+        try:
+            self.server = http.server.ThreadingHTTPServer((self.address, self.port), Handler)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # another build on this agent has it, both share the cache dir anyway
+            utils.debug(f"PKG-CACHE: port {self.port} in use, taking a free one")
+            self.server = http.server.ThreadingHTTPServer((self.address, 0), Handler)
+        self.port = self.server.server_address[1]
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        utils.debug(f"PKG-CACHE: apt proxy listening on {self.url}")
+
+
+    @property
+    def url(self):
+        return f"http://{self.address}:{self.port}"
+
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.evict()
+
+
+    def handle(self, request):
+        url = request.path
+        if not is_allowed(url, self.hosts):
+            request.send_error(403, "only http:// requests to the archive hosts are allowed")
+            self.count(errors=1)
+            return
+        filename = self.cache_file(url)
+        if is_cacheable(url) and os.path.isfile(filename):
+            size = os.path.getsize(filename)
+            request.send_response(200)
+            request.send_header("Content-Type", "application/octet-stream")
+            request.send_header("Content-Length", str(size))
+            request.end_headers()
+            with open(filename, "rb") as fd:
+                shutil.copyfileobj(fd, request.wfile, CHUNK_SIZE)
+            os.utime(filename)
+            self.count(hits=1, bytes_from_cache=size)
+            return
+
+        headers = {key: value for key, value in request.headers.items()
+                   if key.lower() in ("if-modified-since", "range", "user-agent")}
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        try:
+            response = opener.open(urllib.request.Request(url, headers=headers), timeout=60)
+        except urllib.error.HTTPError as e:
+            # not modified, not found, etc. go back as they are
+            body = e.read()
+            request.send_response(e.code)
+            for key, value in e.headers.items():
+                if key.lower() not in ("connection", "transfer-encoding", "content-length"):
+                    request.send_header(key, value)
+            request.send_header("Content-Length", str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+            self.count(passthrough=1)
+            return
+        except (urllib.error.URLError, OSError) as e:
+            request.send_error(502, f"upstream error: {e}")
+            self.count(errors=1)
+            return
+
+        # only complete downloads of a full file go to the cache
+        store = is_cacheable(url) and response.status == 200 and "range" not in headers
+        temp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        received = 0
+        with response:
+            request.send_response(response.status)
+            for key, value in response.headers.items():
+                if key.lower() not in ("connection", "transfer-encoding"):
+                    request.send_header(key, value)
+            request.end_headers()
+            fd = open(temp, "wb") if store else None
+            try:
+                while chunk := response.read(CHUNK_SIZE):
+                    received += len(chunk)
+                    request.wfile.write(chunk)
+                    if fd:
+                        fd.write(chunk)
+            except OSError:
+                store = False
+            finally:
+                if fd:
+                    fd.close()
+        length = response.headers.get("Content-Length")
+        if store and (length is None or int(length) == received):
+            os.replace(temp, filename)
+        elif os.path.exists(temp):
+            os.remove(temp)
+        if is_cacheable(url):
+            self.count(misses=1, bytes_downloaded=received)
+        else:
+            self.count(passthrough=1, bytes_downloaded=received)
+
+
+    def evict(self):
+        """Removes the least recently used files until the cache fits"""
+        files = [f"{self.cache_dir}/{name}" for name in os.listdir(self.cache_dir)
+                 if not name.endswith(".tmp")]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(name) for name in files)
+        for name in files:
+            if total <= self.max_size:
+                break
+            total -= os.path.getsize(name)
+            os.remove(name)
+
+
+    def report(self):
+        """Hit ratio and bytes saved, for the log and the artifacts"""
+        with self.lock:
+            stats = dict(self.stats)
+        cacheable = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / cacheable, 3) if cacheable else None
+        stats["bytes_saved"] = stats["bytes_from_cache"]
+        return stats
+
+
+    def write_report(self):
+        stats = self.report()
+        utils.debug(f"PKG-CACHE: {stats['hits']} hits, {stats['misses']} misses "
+                    f"(hit ratio {stats['hit_ratio']}), "
+                    f"{stats['bytes_saved'] / 1024 ** 2:.1f}MB saved, "
+                    f"{stats['bytes_downloaded'] / 1024 ** 2:.1f}MB downloaded")
+        filename = utils.run_path(STATS_FILE)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        utils.write_file(utils.yaml_dump(stats), filename)
+
+
+def get_proxies(package_cache):
+    """Returns (apt proxy url, snap proxy url, local PackageCache or None) for the
+       'package_cache' profile setting. The local cache is not started yet, its
+       url (the apt proxy) is only known once it is"""
+    if not package_cache:
+        return None, None, None
+    if package_cache.get("local"):
+        local = PackageCache(package_cache["address"],
+                             port=package_cache.get("port", DEFAULT_PORT),
+                             cache_dir=package_cache.get("dir", CACHE_DIR),
+                             max_size_gb=package_cache.get("max_size_gb", MAX_SIZE_GB),
+                             mirrors=package_cache.get("mirrors", []))
+        return None, package_cache.get("snap_proxy"), local
+    return package_cache.get("apt_proxy"), package_cache.get("snap_proxy"), None
+
+
+def remote_setup_cmd(apt_proxy, snap_proxy):
+    """Shell commands (run as root) pointing apt and snapd to the proxies"""
+    cmd = "set -xe\n"
+    if apt_proxy:
+        cmd += f"echo 'Acquire::http::Proxy \"{apt_proxy}\";' > {APT_CONF_FILE}\n"
+    if snap_proxy:
+        cmd += f"snap set system proxy.http={snap_proxy} proxy.https={snap_proxy}\n"
+    return cmd
+
+
+def remote_cleanup_cmd():
+    """Undoes the apt setting, needed when the proxy does not outlive the build
+       step (a local one), otherwise apt would fail later on"""
+    return f"rm -f {APT_CONF_FILE}"
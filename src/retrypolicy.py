@@ -0,0 +1,195 @@
+#!/bin/false
+
+"""
+Decides what to do when a remote command fails, based on its output and return
+code, so that a transient error costs a retry instead of a whole new build.
+
+Each rule matches when all its patterns were seen in the output, in order, and
+the return code is one of its rcs (any failure if not given, so a rule without
+patterns matches any failure).
+The first matching rule that has retries left wins (one that ran out of them
+gives way to the next one that matches) and its action is one of:
+  retry: run the command again, waiting backoff seconds (doubled each time)
+  remediate: run the remediation command first, then retry
+  abort: do not retry. Abort rules are checked while the command runs and
+         stop it right away, returning ABORT_RC, instead of waiting for it
+         to fail on its own (it is not going to recover)
+
+Rules come from build_description.py EXTRA_INFO_RE and from the old websocket
+and ceph hacks. Commands opt in by passing retry_policy to SSHClient.execute.
+Commands that can not simply run again once partly applied (cluster bootstrap,
+join and deploy) use CLUSTER_POLICY and ABORT_ONLY_POLICY instead of
+DEFAULT_POLICY.
+"""
+
+import re
+
+RETRY = "retry"
+REMEDIATE = "remediate"
+ABORT = "abort"
+
+# rc returned when an abort rule stops a command
+ABORT_RC = 1002
+
+# the old hack retried bootstrap on it, it fails before anything is applied
+WEBSOCKET_RULE = {
+    "name": "websocket-error",
+    "patterns": [r"Error: Unable to connect to websocket"],
+    "action": RETRY,
+    "retries": 1,
+    "backoff": 0,
+}
+
+RULES = [
+    WEBSOCKET_RULE,
+    {
+        "name": "terraform-temporary-overload",
+        "patterns": [r"The service is currently unable .* temporary overloading or maintenance."],
+        "action": RETRY,
+        "retries": 3,
+        "backoff": 60,
+    }, {
+        "name": "ubuntu-image-timeout",
+        "patterns": [r"Gateway Timeout", r"openstack_images_image_v2"],
+        "action": RETRY,
+        "retries": 2,
+        "backoff": 30,
+    }, {
+        "name": "microceph-unit-timeout",
+        "patterns": [r"Timed out while waiting for units microceph/. to be ready"],
+        "action": RETRY,
+        "retries": 1,
+        "backoff": 30,
+    }, {
+        "name": "hypervisor-unit-timeout",
+        "patterns": [r"Timed out while waiting for units openstack-hypervisor/. to be ready"],
+        "action": RETRY,
+        "retries": 1,
+        "backoff": 30,
+    }, {
+        "name": "model-openstack-timeout",
+        "patterns": [r"Timed out while waiting for model .openstack. to be ready"],
+        "action": RETRY,
+        "retries": 1,
+        "backoff": 30,
+    }, {
+        "name": "juju-operator-refresh-arch",
+        "patterns": [r"Error: Client Error", r"refresh arch not valid", r"Error configuring cloud"],
+        "action": ABORT,
+    }, {
+        "name": "microceph-unable-list-disks",
+        "patterns": [r"Error: Unable to list disks"],
+        "action": ABORT,
+    },
+]
+
+# workaround for ceph size/min_size bug (temporary), only makes sense when the
+# node running the command has storage role so it is not in RULES by default.
+# It shows up as image, unit or model timeouts, so it goes before those rules
+# (see CEPH_CONFIGURE_POLICY)
+CEPH_MIN_SIZE_RULE = {
+    "name": "ceph-pool-min-size",
+    "patterns": [],
+    "action": REMEDIATE,
+    "retries": 1,
+    "backoff": 0,
+    "remediation": """set -x
+        sudo ceph osd pool set glance min_size 1
+        sudo ceph osd pool set glance size 1 --yes-i-really-mean-it
+        sudo ceph osd pool set cinder-ceph min_size 1
+        sudo ceph osd pool set cinder-ceph size 1 --yes-i-really-mean-it
+    """,
+}
+
+# configure was always tried twice before giving up, whatever the failure (the
+# ceph rule above does the same with its remediation when it applies)
+CONFIGURE_RULE = {
+    "name": "configure-any-failure",
+    "patterns": [],
+    "action": RETRY,
+    "retries": 1,
+    "backoff": 0,
+}
+
+
+class RetryPolicy:
+
+    def __init__(self, rules=RULES, extra_rules=()):
+        self.rules = []
+        for rule in list(rules) + list(extra_rules):
+            self.rules.append(dict(
+                rule,
+                patterns=[re.compile(pattern) for pattern in rule.get("patterns", [])],
+                rc=tuple(rule["rc"]) if rule.get("rc") else None,
+                retries=rule.get("retries", 0),
+                backoff=rule.get("backoff", 0)))
+
+
+    def matcher(self):
+        """Returns a new matcher to follow the output of one command run"""
+        return PolicyMatcher(self)
+
+
+    def with_rules(self, *rules):
+        """A copy of this policy with more rules, checked after the existing ones"""
+        policy = RetryPolicy([])
+        policy.rules = self.rules + RetryPolicy(rules).rules
+        return policy
+
+
+class PolicyMatcher:
+    """Keeps how far each rule got in its list of patterns for one command run"""
+
+    def __init__(self, policy):
+        self.rules = policy.rules
+        self.progress = [0] * len(self.rules)
+        self.aborted = None
+
+
+    def feed(self, line):
+        """Checks one line of output, returns the abort rule if one fully matched"""
+        for n, rule in enumerate(self.rules):
+            patterns = rule["patterns"]
+            # several patterns of the same rule can be in the same line
+            while self.progress[n] < len(patterns) and patterns[self.progress[n]].search(line):
+                self.progress[n] += 1
+                if self.progress[n] == len(patterns) and rule["action"] == ABORT \
+                        and not self.aborted:
+                    self.aborted = rule
+        return self.aborted
+
+
+    def stop_rc(self):
+        """ABORT_RC once an abort rule matched, None otherwise (for SSHClient drain)"""
+        return ABORT_RC if self.aborted else None
+
+
+    def rule(self, rc, triggered=None):
+        """The first rule that applies to the run that ended with rc, or None.
+           triggered (rule name -> times it was applied) skips the rules that
+           are out of retries"""
+        if rc == 0:
+            return None
+        if self.aborted:
+            return self.aborted
+        triggered = triggered or {}
+        for n, rule in enumerate(self.rules):
+            if self.progress[n] == len(rule["patterns"]) and \
+                    (not rule["rc"] or rc in rule["rc"]) and \
+                    triggered.get(rule["name"], 0) < rule["retries"]:
+                return rule
+        return None
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+# configure on a primary with storage: the ceph workaround on any failure first,
+# as the old hack did, then the usual rules
+CEPH_CONFIGURE_POLICY = RetryPolicy([CEPH_MIN_SIZE_RULE] + RULES)
+
+# a cluster bootstrap, join or deploy that timed out has done part of its work,
+# running it again fails on what is already there: no retries, only failing early
+ABORT_ONLY_POLICY = RetryPolicy([rule for rule in RULES if rule["action"] == ABORT])
+# as the old hack did for bootstrap, they can still be tried again on the
+# websocket error (nothing was applied yet)
+CLUSTER_POLICY = ABORT_ONLY_POLICY.with_rules(WEBSOCKET_RULE)
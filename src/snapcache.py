@@ -0,0 +1,133 @@
+#!/bin/false
+
+"""
+Local cache of snaps on the orchestrator (the Jenkins agent). A snap is downloaded
+once per channel revision, together with its assertions, then pushed to the nodes
+and installed from the file, instead of having every node of every build download
+the same snap from the store over the lab uplink.
+
+Enabled with 'snap_cache' in the profile, either True (defaults) or a dict with
+'dir' and/or 'max_size_gb'. The least recently used revisions are evicted when
+the cache grows over its maximum size. The cache is shared by the jobs on the
+agent: lookups, downloads and evictions hold its lock, pushes to the nodes hold
+it shared so that nothing they are sending gets evicted.
+"""
+
+import glob
+import os
+import re
+import shutil
+import tempfile
+import utils
+
+CACHE_DIR = "~/.cache/sunbeam-ci/snaps"
+MAX_SIZE_GB = 10
+LOCK_FILE = ".lock"
+
+
+def get_settings(snap_cache):
+    """Turns the 'snap_cache' config value into (cache dir, max size in bytes),
+       or None when the cache is disabled"""
+    if not snap_cache:
+        return None
+    if snap_cache is True:
+        snap_cache = {}
+    cache_dir = os.path.expanduser(snap_cache.get("dir", CACHE_DIR))
+    max_size = int(snap_cache.get("max_size_gb", MAX_SIZE_GB) * 1024 ** 3)
+    return cache_dir, max_size
+
+
+def store_revision(snap, channel):
+    """Asks the store for the current revision of snap in channel, returns None
+       if it cannot be found (i.e. the channel is closed and follows another)"""
+    out = utils.exec_cmd_capture(f"snap info {snap}")
+    if match := re.search(rf"^ +{re.escape(channel)}: +\S+ +\S+ +\((\d+)\) ", out, re.MULTILINE):
+        return match.group(1)
+    return None
+
+
+def fetch(snap, channel, snap_cache):
+    """Makes sure the current revision of snap in channel is in the cache and
+       returns the paths of its (snap file, assert file), or None if it could
+       not be downloaded (callers should then install from the store)"""
+    cache_dir, max_size = get_settings(snap_cache)
+    os.makedirs(cache_dir, exist_ok=True)
+    # lookup, download and eviction as one, other jobs may be doing the same
+    with utils.file_lock(f"{cache_dir}/{LOCK_FILE}"):
+        if revision := store_revision(snap, channel):
+            snap_file = f"{cache_dir}/{snap}_{revision}.snap"
+            assert_file = f"{cache_dir}/{snap}_{revision}.assert"
+            if os.path.isfile(snap_file) and os.path.isfile(assert_file):
+                utils.debug(f"SNAP-CACHE: using cached {snap} revision {revision} for {channel}")
+                # mark as recently used, eviction goes by mtime
+                os.utime(snap_file)
+                os.utime(assert_file)
+                return snap_file, assert_file
+
+        utils.debug(f"SNAP-CACHE: downloading {snap} from {channel} into the cache")
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tempdir:
+            rc = utils.exec_cmd(
+                f"snap download {snap} --channel={channel} --target-directory={tempdir}")
+            snap_files = glob.glob(f"{tempdir}/{snap}_*.snap")
+            if rc != 0 or not snap_files:
+                utils.debug("SNAP-CACHE: could not download snap, not using the cache")
+                return None
+            # the file name tells the actual revision that was downloaded
+            snap_file = f"{cache_dir}/{os.path.basename(snap_files[0])}"
+            assert_file = f"{snap_file[:-len('.snap')]}.assert"
+            shutil.move(snap_files[0], snap_file)
+            shutil.move(f"{snap_files[0][:-len('.snap')]}.assert", assert_file)
+
+        evict(cache_dir, max_size, keep=(snap_file, assert_file))
+        return snap_file, assert_file
+
+
+def evict(cache_dir, max_size, keep=()):
+    """Removes the least recently used snaps until the cache fits in max_size,
+       with the cache lock held (see fetch)"""
+    files = sorted(glob.glob(f"{cache_dir}/*.snap"), key=os.path.getmtime)
+    sizes = {}
+    for snap_file in files:
+        assert_file = f"{snap_file[:-len('.snap')]}.assert"
+        sizes[snap_file] = os.path.getsize(snap_file) + (
+            os.path.getsize(assert_file) if os.path.isfile(assert_file) else 0)
+    total = sum(sizes.values())
+    for snap_file in files:
+        if total <= max_size:
+            break
+        if snap_file in keep:
+            continue
+        utils.debug(f"SNAP-CACHE: evicting {snap_file}")
+        os.remove(snap_file)
+        assert_file = f"{snap_file[:-len('.snap')]}.assert"
+        if os.path.isfile(assert_file):
+            os.remove(assert_file)
+        total -= sizes[snap_file]
+
+
+def install(sshclient, snap, channel, cached):
+    """Pushes the cached (snap file, assert file) to the node and installs it,
+       tracking channel so that later refreshes behave as a store install (or
+       installs from the store if another job evicted it meanwhile).
+       Returns (out, rc) like SSHClient.execute"""
+    snap_file, assert_file = cached
+    remote_snap = os.path.basename(snap_file)
+    remote_assert = os.path.basename(assert_file)
+    with utils.file_lock(f"{os.path.dirname(snap_file)}/{LOCK_FILE}", shared=True):
+        evicted = not (os.path.isfile(snap_file) and os.path.isfile(assert_file))
+        if not evicted:
+            sshclient.file_put(assert_file, remote_assert)
+            sshclient.file_put(snap_file, remote_snap)
+    if evicted:
+        utils.debug(f"SNAP-CACHE: {snap_file} was evicted, installing from the store")
+        return sshclient.execute(
+            f"sudo snap install {snap} --channel {channel}",
+            verbose=True, get_pty=True, combine_stderr=True, filtered=True)
+    cmd = f"""set -e
+        sudo snap ack {remote_assert}
+        sudo snap install ./{remote_snap}
+        sudo snap switch --channel={channel} {snap}
+        rm -f {remote_snap} {remote_assert}
+    """
+    return sshclient.execute(
+        cmd, verbose=True, get_pty=True, combine_stderr=True, filtered=True)
@@ -1,10 +1,25 @@
 
+import atexit
+import codecs
+import collections
 import fnmatch
+import io
 import os
 import paramiko
 import re
+import retrypolicy
+import select
+import shlex
+import shutil
+import tarfile
+import textwrap
+import threading
 import time
+import tracing
 import utils
+import uuid
+from outputfilter import DEFAULT_FILTER
+from watchdog import WATCHDOG_RC
 
 KEY_FILES = [
     (paramiko.RSAKey, "rsa"),
@@ -13,6 +28,268 @@ KEY_FILES = [
     (paramiko.Ed25519Key, "ed25519"),
 ]
 
+# how much to read from the channel at once, and how long to wait for data
+READ_CHUNK_SIZE = 32768
+SELECT_TIMEOUT = 1
+# SFTP channel tuning, a bigger window and packets keep more data in flight
+# per round trip which is what limits transfers over high latency links
+SFTP_WINDOW_SIZE = 64 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 64 * 1024
+# how much of the output is kept in memory when it is being sent to a sink
+TAIL_SIZE = 65536
+# rc returned when a command is stopped because its cancel_event was set
+CANCELLED_RC = 1004
+# the glob parts of a path (left unquoted for the remote shell)
+GLOB_RE = re.compile(r"(\*|\?|\[!?[\w.-]+\])")
+
+
+def quote_glob(path):
+    """Quotes path for the shell, except for its glob wildcards"""
+    return "".join(part if GLOB_RE.fullmatch(part) else shlex.quote(part)
+                   for part in GLOB_RE.split(path) if part)
+
+
+def tar_member_name(member_name, rename):
+    """Local file name for a tar member: the base name of what the first
+       matching rename rule (compiled regex, replacement) turns the whole
+       member path into, or its base name. Rules should match the whole path
+       (anchor them), sub leaves whatever they do not match in the name"""
+    for regex, replacement in rename:
+        if regex.search(member_name):
+            return os.path.basename(regex.sub(replacement, member_name))
+    return os.path.basename(member_name)
+
+
+class TransportPool:
+    """Process-wide cache of authenticated transports, so that every SSHClient
+       pointing to the same user@host (through the same jumphost) shares a
+       single TCP connection and key exchange instead of negotiating its own"""
+
+    def __init__(self, max_idle=300, check_after=30):
+        # transports without users are closed after being idle for max_idle secs
+        self.max_idle = max_idle
+        # transports idle for more than check_after secs are probed before reuse
+        self.check_after = check_after
+        self.lock = threading.Lock()
+        # key -> the transport handed out for it (and how it is doing)
+        self.entries = {}
+        # transport -> references held on it
+        self.refs = {}
+        # transports replaced in entries that are still in use, closed on their
+        # last release
+        self.retired = set()
+        # transport -> its SFTP session, shared by all the clients using it
+        self.sftp_sessions = {}
+
+
+    def acquire(self, key, connect, hold=True):
+        """Returns a live transport for key, creating one with connect() if the
+           pooled one is missing or unhealthy. When hold is set, a reference
+           is taken on the transport and must be given back with release()"""
+        self.evict_idle()
+        with self.lock:
+            entry = self.entries.setdefault(key, {
+                "transport": None, "last_used": 0, "discard": False,
+                "waiting": 0, "lock": threading.Lock()})
+            # keeps the entry from being evicted while we get its transport
+            entry["waiting"] += 1
+        try:
+            # only one thread connects to a given key, others wait and reuse it
+            with entry["lock"]:
+                if not self.__healthy(entry):
+                    if entry["transport"]:
+                        # others may still be using it, it only goes away
+                        # with their last reference
+                        utils.debug(f"SSH-POOL: replacing stale transport for {key}")
+                        self.__retire(entry["transport"])
+                        entry["transport"] = None
+                    entry["transport"] = connect()
+                    entry["discard"] = False
+                else:
+                    utils.debug(f"SSH-POOL: reusing transport for {key}")
+                transport = entry["transport"]
+                with self.lock:
+                    entry["last_used"] = time.monotonic()
+                    if hold:
+                        self.refs[transport] = self.refs.get(transport, 0) + 1
+                return transport
+        finally:
+            with self.lock:
+                entry["waiting"] -= 1
+
+
+    def release(self, key, transport, discard=False):
+        """Gives back a reference on transport. With discard it is not handed
+           out again, new acquirers get a fresh one, and it gets closed as soon
+           as nobody else is using it"""
+        with self.lock:
+            refs = self.refs.get(transport, 0) - 1
+            if refs > 0:
+                self.refs[transport] = refs
+            else:
+                self.refs.pop(transport, None)
+            entry = self.entries.get(key)
+            current = entry is not None and entry["transport"] is transport
+            if current:
+                entry["last_used"] = time.monotonic()
+                entry["discard"] = entry["discard"] or discard
+            close = refs <= 0 and (
+                transport in self.retired or
+                (current and entry["discard"] and entry["waiting"] == 0))
+            if close:
+                self.retired.discard(transport)
+                if current:
+                    del self.entries[key]
+        if close:
+            utils.debug(f"SSH-POOL: closing discarded transport for {key}")
+            self.__close(transport)
+        elif current and discard:
+            # new transfers go to the transport that replaces it
+            self.forget_sftp(transport)
+
+
+    def evict_idle(self):
+        """Closes transports that nobody used for longer than max_idle"""
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry["transport"] not in self.refs and entry["waiting"] == 0 and \
+                        now - entry["last_used"] > self.max_idle:
+                    evicted.append((key, self.entries.pop(key)))
+        for key, entry in evicted:
+            if entry["transport"]:
+                utils.debug(f"SSH-POOL: evicting idle transport for {key}")
+                self.__close(entry["transport"])
+
+
+    def close_all(self):
+        with self.lock:
+            transports = [entry["transport"] for entry in self.entries.values()]
+            transports += list(self.retired)
+            self.entries.clear()
+            self.retired.clear()
+            self.refs.clear()
+        for transport in transports:
+            if transport:
+                self.__close(transport)
+
+
+    def sftp(self, transport, open_sftp):
+        """The SFTP session of transport, opened with open_sftp() on first use
+           and shared by everyone using the transport (paramiko serializes
+           the requests of concurrent users)"""
+        with self.lock:
+            session = self.sftp_sessions.setdefault(
+                transport, {"sftp": None, "lock": threading.Lock()})
+        # only one thread opens it, others wait and reuse it
+        with session["lock"]:
+            if session["sftp"] is None:
+                session["sftp"] = open_sftp()
+            return session["sftp"]
+
+
+    def forget_sftp(self, transport, sftp=None):
+        """Stops handing out the SFTP session of transport (only if it is still
+           sftp, when given), so that the next user opens a new one. It is
+           returned, not closed: others may be in the middle of a transfer"""
+        with self.lock:
+            session = self.sftp_sessions.get(transport)
+            if not session or (sftp is not None and session["sftp"] is not sftp):
+                return None
+            del self.sftp_sessions[transport]
+            return session["sftp"]
+
+
+    def __close(self, transport):
+        if sftp := self.forget_sftp(transport):
+            try:
+                sftp.close()
+            except (paramiko.SSHException, EOFError, OSError):
+                pass
+        transport.close()
+
+
+    def __retire(self, transport):
+        """Takes transport out of the pool, closing it if nobody uses it"""
+        with self.lock:
+            if transport in self.refs:
+                self.retired.add(transport)
+                retired = True
+            else:
+                retired = False
+        if retired:
+            # its SFTP session goes away with it, new transfers use the new one
+            self.forget_sftp(transport)
+        else:
+            self.__close(transport)
+
+
+    def __healthy(self, entry):
+        transport = entry["transport"]
+        # this is better than 'is_active()' because it tests both
+        if entry["discard"] or not transport or not transport.is_authenticated():
+            return False
+        if time.monotonic() - entry["last_used"] < self.check_after:
+            return True
+        # idle for a while, make sure the other side is still there (flaky links
+        # can leave a transport that looks authenticated but is long gone)
+        try:
+            transport.open_session(timeout=10).close()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+
+POOL = TransportPool()
+atexit.register(POOL.close_all)
+
+
+class OutputSink:
+    """Receives the output of a command as it arrives. The target can be a local
+       file path, an open file object or a callback (called with each piece of
+       text). With a target, only a bounded tail is kept in memory (to be used
+       in error messages), otherwise everything is kept"""
+
+    def __init__(self, target=None, tail_size=TAIL_SIZE):
+        self.tail_size = tail_size if target is not None else None
+        self.chunks = collections.deque()
+        self.size = 0
+        self.fd = None
+        self.callback = None
+        if isinstance(target, (str, os.PathLike)):
+            utils.debug(f"streaming output to file {target}")
+            self.fd = open(target, "w", encoding="utf-8")
+            self.callback = self.fd.write
+        elif target is not None:
+            self.callback = target.write if hasattr(target, "write") else target
+
+
+    def write(self, text):
+        if not text:
+            return
+        if self.callback:
+            self.callback(text)
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.tail_size is not None:
+            while self.size - len(self.chunks[0]) >= self.tail_size:
+                self.size -= len(self.chunks.popleft())
+
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+
+    def getvalue(self):
+        value = "".join(self.chunks)
+        if self.tail_size is not None:
+            value = value[-self.tail_size:]
+        return value
+
+
 class SSHClient:
 
     def __init__(self, user, host, jumphost = None):
@@ -21,12 +298,35 @@ class SSHClient:
         self.transport = None
         self.ssh_agent = paramiko.Agent()
         self.jumphost = jumphost
+        # whether we are holding a reference in the transport pool
+        self.pooled = False
+
+
+    def __pool_key(self):
+        jumphost = (self.jumphost.user, self.jumphost.host) if self.jumphost else None
+        return (self.user, self.host, jumphost)
 
 
     def __connect(self):
+        if self.transport:
+            # this is better than 'is_active()' because it tests both
+            if self.transport.is_authenticated():
+                return
+
+        # a reconnect (after the transport died) gives back the reference held
+        # on the dead one first
+        if self.pooled:
+            POOL.release(self.__pool_key(), self.transport)
+            self.pooled = False
+        self.transport = POOL.acquire(self.__pool_key(), self.__new_transport)
+        self.pooled = True
+
+
+    def __new_transport(self):
 
         def get_new_transport():
             if self.jumphost:
+                self.jumphost.__connect()
                 # Not sure what the src port here is used for, but it is needed
                 src_addr = (self.jumphost.host, 22)
                 dst_addr = (self.host, 22)
@@ -36,24 +336,20 @@ class SSHClient:
             else:
                 return paramiko.Transport((self.host, 22))
 
-        if self.transport:
-            # this is better than 'is_active()' because it tests both
-            if self.transport.is_authenticated():
-                return
-
+        transport = None
         # connect and negotiate session (and retry a few times before giving up)
         for t in range(1,11):
             # in case last transport existed and is now disconnected/timed out
             # make sure to free the thread preemptively
-            if self.transport:
-                self.transport.close()
+            if transport:
+                transport.close()
             utils.debug(f"Starting new SSH connection to {self.user}@{self.host} "
                 f"jumphost={self.jumphost.host if self.jumphost else None}")
             try:
                 # start the network connection (can emit SSHException if it fails)
-                self.transport = get_new_transport()
+                transport = get_new_transport()
                 # start the ssh2 negotiation (can also emit SSHException if it fails)
-                self.transport.start_client()
+                transport.start_client()
                 break
             except paramiko.SSHException:
                 utils.debug(f"SSH Connection failed (#{t}), retrying")
@@ -65,10 +361,10 @@ class SSHClient:
         for key in self.ssh_agent.get_keys():
             # in case the key does not succeed authenticating
             try:
-                self.transport.auth_publickey(self.user, key)
+                transport.auth_publickey(self.user, key)
             except paramiko.AuthenticationException:
                 pass
-            if self.transport.is_authenticated():
+            if transport.is_authenticated():
                 break
         else:
             for keytype, name in KEY_FILES:
@@ -80,177 +376,489 @@ class SSHClient:
                         pass
                     # in case the key does not succeed authenticating
                     try:
-                        self.transport.auth_publickey(self.user, key)
+                        transport.auth_publickey(self.user, key)
                     except paramiko.AuthenticationException:
                         pass
-                    if self.transport.is_authenticated():
+                    if transport.is_authenticated():
                         break
         
-        if not self.transport.is_authenticated():
+        if not transport.is_authenticated():
             utils.die("Could not find a suitable SSH key to authenticate")
 
+        # keep idle pooled transports alive and detect dead links early
+        transport.set_keepalive(30)
+        return transport
 
-    def close(self):
+
+    def close(self, discard=False):
+        """Gives the connection back to the pool. Use discard to make sure the
+           next command runs on a brand new connection (i.e. new login groups)"""
         utils.debug(f"Closing SSH connection to {self.user}@{self.host}")
-        self.transport.close()
-
-
-    def execute(self, cmd, verbose=False, get_pty=False, combine_stderr=False, filtered=False):
-
-        def strip_garbage(line):
-            # Spaces at the end
-            line = re.sub(r" *$", '', line)
-            # ANSI Codes
-            line = re.sub(r"\x1b\[\??[0-9;]*[hlmAGKHF]", '', line)
-            # the spinning wheel + download percentage at snap install
-            line = re.sub("^((Ensure prerequisites|Download snap|Fetch and check assertions|"
-                "Mount snap|Setup snap|Copy snap|Connect .* to|Run health check|"
-                "Run install hook|Start snap|Run service command|"
-                "Run configure hook|Automatically connect eligible plugs).*?)"
-                " +([-\\\|/]|[0-9]+% .*)$", r'\1', line)
-            # The spinning wheel at the status lines
-            line = re.sub("[⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏] *", '> ', line)
-            # Apt "Reading database" verboseness
-            if r"(Reading database ..." in line:
-                line = ""
-            return line
-
-        def maybe_filter_and_print(lineraw, verbose, filtered):
-            nonlocal last_line, delayed_line
-            # TODO: move this out of the function so it does not get compiled every time
-            detect_two_lines = re.compile(
-                r"> Deploying OpenStack Control Plane to Kubernetes \(this may take a while\)|"
-                r"> Resizing OpenStack Control Plane to match appropriate topology|"
-                r"> Applying local hypervisor settings \.\.\. setting hypervisor configuration for|"
-                r"> No sunbeam key found in OpenStack\. Creating SSH key at|"
-                r"> Enabling OpenStack telemetry application \.\.\. waiting for services to come|"
-                r"> Enabling OpenStack observability application \.\.\. waiting for services to come|"
-                r"> Enabling OpenStack validation application ... waiting for services to come|"
-                r"> Applying hypervisor settings ... setting hypervisor configuration for|"
-                r"> Copying .* from tempest")
-
-            if not filtered:
-                if verbose:
-                    print(lineraw, end="") # avoid adding another \n in case of raw print
-                return lineraw
-
-            # we may have received lots of lines with \r separator in one raw line
-            # output may be delayed until a \n comes, but then all lines are shown
-            lines_buffer = ""
-            for line in lineraw.rstrip().split("\r"):
-                line = strip_garbage(line)
-                # some lines get empty after removing all garbage
-                # this ends up removing originally empty lines too
-                if not line:
-                    continue
-                if delayed_line:
-                    line = f"{delayed_line} {line}"
-                    delayed_line = None
-                elif detect_two_lines.search(line):
-                    delayed_line = line
-                    continue
-                if line != last_line:
-                    if verbose:
-                        print(line)
-                    last_line = line
-                lines_buffer += f"{line}\n"
-            return lines_buffer
+        if self.pooled:
+            POOL.release(self.__pool_key(), self.transport, discard=discard)
+        elif self.transport:
+            POOL.forget_sftp(self.transport)
+            self.transport.close()
+        self.transport = None
+        self.pooled = False
 
+
+    def __open_session(self, cmd, get_pty, combine_stderr):
+        channel = self.transport.open_channel("session")
+        if get_pty:
+            channel.get_pty(term="xterm-256color")
+        channel.set_combine_stderr(combine_stderr)
+        channel.exec_command(cmd)
+        return channel
+
+
+    def __drain(self, channel, on_stdout, on_stderr, span=None, stop=None):
+        """Feeds the raw data of both streams to the callbacks until the command
+           ends, and returns its exit status (also recorded in span, with the
+           amount of bytes received). stop is called on every loop and if it
+           returns an rc the channel is closed (which hangs up a command
+           running with a pty) and that rc is returned"""
+        received = 0
+        rc = None
+        # drain both streams in chunks as soon as anything arrives, so that a
+        # chatty stderr can never fill the channel window and stall the command
+        while True:
+            # look at eof before draining, anything received before it is
+            # already buffered and will be read below
+            eof = channel.eof_received or channel.closed
+            got_data = False
+            if channel.recv_ready():
+                data = channel.recv(READ_CHUNK_SIZE)
+                received += len(data)
+                on_stdout(data)
+                got_data = True
+            if channel.recv_stderr_ready():
+                data = channel.recv_stderr(READ_CHUNK_SIZE)
+                received += len(data)
+                on_stderr(data)
+                got_data = True
+            if stop and (rc := stop()) is not None:
+                utils.debug(f"stopping command with rc {rc}")
+                break
+            if got_data:
+                continue
+            if eof:
+                break
+            select.select([channel], [], [], SELECT_TIMEOUT)
+        if rc is None:
+            rc = channel.recv_exit_status()
+        channel.close()
+        if span is not None:
+            span["rc"] = rc
+            span["bytes"] = received
+        return rc
+
+
+    def execute(self, cmd, verbose=False, get_pty=False, combine_stderr=False, filtered=False,
+                capture_stderr=False, sink=None, retry_policy=None, watchdog=None,
+                cancel_event=None):
+        """Runs cmd remotely and returns (stdout, rc). When capture_stderr is set
+           (and stderr is not combined) the stderr contents are returned as a
+           third item: (stdout, rc, stderr). filtered can be True (default
+           filter) or an OutputFilter built with rules for this command. With
+           a sink (file path, file object or callback) the output is streamed
+           to it and the returned stdout is only its last TAIL_SIZE chars.
+           With a retry_policy (see retrypolicy.py) failures matching its rules
+           are retried and the result of the last run is returned. A watchdog
+           (see watchdog.py) captures diagnostics when the command goes silent.
+           Setting cancel_event (a threading.Event, i.e. from another thread)
+           stops the command within a second and returns CANCELLED_RC"""
+
+        triggered = {}
+        while True:
+            matcher = retry_policy.matcher() if retry_policy else None
+            result = self.__execute_once(cmd, verbose, get_pty, combine_stderr, filtered,
+                                         capture_stderr, sink, matcher, watchdog, cancel_event)
+            if result[1] in (WATCHDOG_RC, CANCELLED_RC):
+                utils.debug(f"command stopped with rc {result[1]}, not retrying")
+                return result
+            if not matcher or result[1] == 0:
+                return result
+            if not (rule := matcher.rule(result[1], triggered)):
+                if triggered:
+                    utils.debug(f"RETRY-POLICY: out of retries ({triggered})")
+                return result
+            name = rule["name"]
+            if rule["action"] == retrypolicy.ABORT:
+                utils.debug(f"RETRY-POLICY: '{name}' matched, not retrying")
+                return result
+            count = triggered.get(name, 0)
+            triggered[name] = count + 1
+            if rule["action"] == retrypolicy.REMEDIATE:
+                utils.debug(f"RETRY-POLICY: '{name}' matched, remediating")
+                out, rc = self.execute(
+                    rule["remediation"], verbose=True, get_pty=True, combine_stderr=True,
+                    filtered=True)
+                if rc != 0:
+                    utils.debug(f"RETRY-POLICY: remediation failed with rc {rc}")
+                    return result
+            delay = rule["backoff"] * 2 ** count
+            utils.debug(f"RETRY-POLICY: '{name}' matched, retrying in {delay}s "
+                        f"(retry {count + 1} of {rule['retries']})")
+            utils.sleep(delay)
+
+
+    def __execute_once(self, cmd, verbose, get_pty, combine_stderr, filtered,
+                       capture_stderr, sink, matcher, watchdog, cancel_event):
+        label = tracing.command_label(cmd)
         self.__connect()
         utils.debug(f"SSH-EXECUTE: starting new execute at host {self.host} "
             f"verbose={verbose} get_pty={get_pty} combine_stderr={combine_stderr} "
-            f"filtered={filtered}")
+            f"filtered={bool(filtered)}")
         if verbose:
             cmd = "set -x; " + cmd
         else:
             utils.debug(f"Commands:\n{cmd.rstrip()}")
-        channel = self.transport.open_channel("session")
-        if get_pty:
-            channel.get_pty(term="xterm-256color")
-        channel.set_combine_stderr(combine_stderr)
-        channel.exec_command(cmd)
 
-        stdout = channel.makefile("r", 1)
-        stdout_buffer = ""
-        last_line = None
-        delayed_line = None
-        # hacks to detect websocket error and retry
-        websocket_error = False
-        websocket_message = "Error: Unable to connect to websocket"
-        while True:
-            if stdout_read := stdout.readline():
-                stdout_buffer += maybe_filter_and_print(stdout_read, verbose, filtered)
+        stdout_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        stderr_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        stdout_sink = OutputSink(sink)
+        stderr_chunks = []
+        # incomplete last line, kept in pieces until its '\n' arrives
+        partial_line = []
+        filter_stream = None
+        if filtered:
+            filter_stream = (DEFAULT_FILTER if filtered is True else filtered).stream()
+
+        watch = watchdog.watch(self, label) if watchdog else None
+
+        def handle_line(stdout_read):
+            if matcher:
+                matcher.feed(stdout_read)
+            if filter_stream:
+                text, new_lines = filter_stream.feed(stdout_read)
+                if verbose and new_lines:
+                    utils.console("".join(f"{line}\n" for line in new_lines))
             else:
-                # empty read means stream closed
-                break
-            # empty stderr buffer but ignore it's content as an independent stream
-            # the only ways to get stderr is to get a pty or combine it with stdout
-            if channel.recv_stderr_ready():
-                bogus = channel.recv_stderr(8192)  # noqa: F841
-            if websocket_message in stdout_read:
-                websocket_error = True
+                text = stdout_read
+                new_lines = True
+                if verbose:
+                    utils.console(stdout_read) # avoid adding another \n in case of raw print
+            # spinners redraw all the time with a pty, only new lines (after the
+            # filter drops the redraws) mean that the command is moving
+            if watch and new_lines:
+                watch.activity()
+            stdout_sink.write(text)
+
+        def handle_stdout(text):
+            if not filter_stream and not verbose and not matcher and not watch:
+                # nothing needs whole lines, pass chunks straight to the sink
+                stdout_sink.write(text)
+                return
+            if "\n" not in text:
+                if text:
+                    partial_line.append(text)
+                return
+            lines = ("".join(partial_line) + text).split("\n")
+            rest = lines.pop()
+            partial_line[:] = [rest] if rest else []
+            for line in lines:
+                handle_line(f"{line}\n")
+
+        def on_stdout(data):
+            handle_stdout(stdout_decoder.decode(data))
+
+        def handle_stderr(data):
+            if capture_stderr:
+                stderr_chunks.append(stderr_decoder.decode(data))
+
+        # any of them can stop the command before it ends by itself
+        stop_checks = [check.stop_rc for check in (matcher, watch) if check]
+        if cancel_event:
+            stop_checks.append(lambda: CANCELLED_RC if cancel_event.is_set() else None)
+
+        def stop():
+            for stop_rc in stop_checks:
+                if (rc := stop_rc()) is not None:
+                    return rc
+            return None
+
+        with tracing.span("ssh-execute", label, host=self.host) as span:
+            try:
+                channel = self.__open_session(cmd, get_pty, combine_stderr)
+                rc = self.__drain(channel, on_stdout, handle_stderr, span,
+                                  stop=stop if stop_checks else None)
+                handle_stdout(stdout_decoder.decode(b"", final=True))
+                if partial_line:
+                    handle_line("".join(partial_line))
+                stdout_buffer = stdout_sink.getvalue()
+            finally:
+                stdout_sink.close()
+
+        if capture_stderr:
+            stderr_chunks.append(stderr_decoder.decode(b"", final=True))
+            return stdout_buffer, rc, "".join(stderr_chunks)
+        return stdout_buffer, rc
 
-        rc = channel.recv_exit_status()
 
-        # hack for websocket error
-        if rc != 0 and websocket_error:
-            rc = 1001
+    def execute_batch(self, commands, combine_stderr=True, sinks=None):
+        """Runs a batch of named commands (a dict of name -> command) in a single
+           remote script, one after the other, so that many small commands cost
+           a single round trip. Each command output comes back framed with its
+           own return code and is split locally. sinks is an optional dict of
+           name -> sink (see execute) for commands whose output should be
+           streamed somewhere. Returns a dict of name -> (stdout, rc)"""
+        sinks = sinks or {}
+        names = list(commands)
+        self.__connect()
+        utils.debug(f"SSH-EXECUTE-BATCH: starting batch of {len(names)} commands at "
+            f"host {self.host} combine_stderr={combine_stderr}")
+        if not names:
+            return {}
+
+        # each output is saved to a file first so that we know its size, which
+        # is then sent ahead of the data: the output itself is never parsed
+        marker = f"BATCH-{uuid.uuid4().hex}"
+        redirect = "2>&1" if combine_stderr else ""
+        script = textwrap.dedent(f"""\
+            __batch_dir=$(mktemp -d)
+            trap 'rm -rf "$__batch_dir"' EXIT
+            __batch_run() {{
+                bash -c "$2" > "$__batch_dir/out" {redirect} < /dev/null
+                __batch_rc=$?
+                printf '%s %s %s %s\\n' {marker} "$1" "$__batch_rc" \\
+                    "$(stat -c %s "$__batch_dir/out")"
+                cat "$__batch_dir/out"
+            }}
+            """)
+        for n, name in enumerate(names):
+            utils.debug(f"Batch command #{n} '{name}':\n{commands[name].rstrip()}")
+            script += f"__batch_run {n} {shlex.quote(commands[name])}\n"
+
+        results = {}
+        state = {"header": b"", "index": None, "left": 0, "sink": None, "decoder": None}
+
+        def finish_frame():
+            name = names[state["index"]]
+            state["sink"].write(state["decoder"].decode(b"", final=True))
+            state["sink"].close()
+            results[name] = (state["sink"].getvalue(), state["rc"])
+            state["index"] = None
+
+        def on_stdout(data):
+            while data:
+                if state["index"] is None:
+                    # reading a frame header, up to the end of line
+                    header, newline, data = data.partition(b"\n")
+                    state["header"] += header
+                    if not newline:
+                        return
+                    fields = state["header"].decode().split()
+                    state["header"] = b""
+                    if len(fields) != 4 or fields[0] != marker:
+                        utils.debug(f"SSH-EXECUTE-BATCH: ignoring unexpected output {fields}")
+                        continue
+                    index, rc, size = (int(x) for x in fields[1:])
+                    state.update({
+                        "index": index, "rc": rc, "left": size,
+                        "sink": OutputSink(sinks.get(names[index])),
+                        "decoder": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+                    })
+                else:
+                    chunk, data = data[:state["left"]], data[state["left"]:]
+                    state["left"] -= len(chunk)
+                    state["sink"].write(state["decoder"].decode(chunk))
+                if state["index"] is not None and state["left"] == 0:
+                    finish_frame()
+
+        with tracing.span("ssh-execute-batch", f"batch of {len(names)} commands",
+                          host=self.host, commands=names) as span:
+            channel = self.__open_session("bash -s", False, False)
+            try:
+                channel.sendall(script.encode())
+                channel.shutdown_write()
+                rc = self.__drain(channel, on_stdout, lambda data: None, span)
+            finally:
+                if state["sink"]:
+                    state["sink"].close()
+        utils.debug(f"SSH-EXECUTE-BATCH: batch finished with return code {rc}")
+
+        for name in names:
+            if name not in results:
+                # the batch was interrupted before getting to this command
+                results[name] = ("", None)
+        return results
+
+
+    def __sftp(self):
+        """Returns the SFTP session of the transport, it is opened on first use
+           and kept (in the pool) for later transfers of any client using it"""
+        self.__connect()
+        transport = self.transport
 
-        return stdout_buffer, rc
+        def open_sftp():
+            utils.debug(f"SSH-SFTP: opening new SFTP session to {self.host}")
+            return paramiko.SFTPClient.from_transport(
+                transport, window_size=SFTP_WINDOW_SIZE, max_packet_size=SFTP_MAX_PACKET_SIZE)
+
+        return POOL.sftp(transport, open_sftp)
+
+
+    def __sftp_run(self, category, label, operation):
+        """Runs operation(sftp) and, if the session broke in the middle of it,
+           opens a new one and tries once more. Errors about the files
+           themselves (i.e. FileNotFoundError) are raised as usual. operation
+           returns (result, bytes transferred)"""
+        with tracing.span(category, label, host=self.host) as span:
+            sftp = self.__sftp()
+            try:
+                result, span["bytes"] = operation(sftp)
+            except (paramiko.SSHException, EOFError) as e:
+                utils.debug(f"SSH-SFTP: session failed ({e!r}), retrying with a new one")
+                # unless another user already replaced it
+                if POOL.forget_sftp(self.transport, sftp):
+                    try:
+                        sftp.close()
+                    except (paramiko.SSHException, EOFError, OSError):
+                        pass
+                result, span["bytes"] = operation(self.__sftp())
+        return result
 
 
     def file_put(self, localpath, remotepath):
-        self.__connect()
         utils.debug(f"SSH-FILE-PUT: local '{localpath}' -> remote '{remotepath}'")
-        sftp_channel = paramiko.SFTPClient.from_transport(self.transport)
-        sftp_channel.put(localpath, remotepath)
-        sftp_channel.close()
+        self.__sftp_run("sftp-put", remotepath,
+                        lambda sftp: (None, sftp.put(localpath, remotepath).st_size))
 
 
     def file_get(self, remotepath, localpath):
         """both remote and local paths need to be exact files (no globs,
            not any other epansions)"""
-        self.__connect()
         utils.debug(f"SSH-FILE-GET: remote '{remotepath}' -> local '{localpath}'")
-        sftp_channel = paramiko.SFTPClient.from_transport(self.transport)
-        sftp_channel.get(remotepath, localpath)
-        sftp_channel.close()
+
+        def get(sftp):
+            sftp.get(remotepath, localpath)
+            return None, os.path.getsize(localpath)
+
+        self.__sftp_run("sftp-get", remotepath, get)
 
 
     def file_get_glob(self, remotepath, pattern, localpath):
         """remotepath must be dir/, pattern is a glob, destination must be
            dir/ (ending in slash)"""
-        self.__connect()
         utils.debug(f"SSH-FILE-GET-GLOB: downloading remote path '{remotepath}' "
             f"glob: '{pattern}', to local dir '{localpath}'")
-        sftp_channel = paramiko.SFTPClient.from_transport(self.transport)
-        try:
-            list_dir = sftp_channel.listdir(remotepath)
-        except FileNotFoundError:
-            utils.debug("remote dir does not exist, ignoring")
-            return
-        for remotefile in list_dir:
-            if fnmatch.fnmatch(remotefile, pattern):
-                utils.debug(f"SSH-FILE-GET-GLOB: remote '{remotepath}{remotefile}' "
-                    f"-> local '{localpath}{remotefile}'")
-                sftp_channel.get(f"{remotepath}{remotefile}", f"{localpath}{remotefile}")
-        sftp_channel.close()
+
+        def get_glob(sftp):
+            transferred = 0
+            try:
+                list_dir = sftp.listdir(remotepath)
+            except FileNotFoundError:
+                utils.debug("remote dir does not exist, ignoring")
+                return None, transferred
+            for remotefile in list_dir:
+                if fnmatch.fnmatch(remotefile, pattern):
+                    utils.debug(f"SSH-FILE-GET-GLOB: remote '{remotepath}{remotefile}' "
+                        f"-> local '{localpath}{remotefile}'")
+                    sftp.get(f"{remotepath}{remotefile}", f"{localpath}{remotefile}")
+                    transferred += os.path.getsize(f"{localpath}{remotefile}")
+            return None, transferred
+
+        self.__sftp_run("sftp-get-glob", f"{remotepath}{pattern}", get_glob)
+
+
+    def file_get_tar(self, paths, localpath, sudo=False, compress=True, rename=None):
+        """Downloads many remote files in a single pass, by running one remote
+           tar over paths (files or globs, relative to the home dir) and
+           extracting the stream locally as it arrives. Files are saved flat
+           in localpath (a dir ending in slash) with their base name, unless
+           one of the rename rules, a list of (regex, replacement) tried in
+           order on the remote path, matches it. Missing paths are ignored.
+           Returns (list of local files written, list of errors), the errors
+           being empty only if the whole archive arrived and was extracted"""
+        self.__connect()
+        utils.debug(f"SSH-FILE-GET-TAR: downloading remote paths {paths} to local dir "
+            f"'{localpath}' sudo={sudo} compress={compress}")
+        rename = [(re.compile(regex), replacement) for regex, replacement in rename or []]
+        flags = "czf" if compress else "cf"
+        # globs are expanded by the remote shell (with sudo, as root), paths that
+        # do not match anything are dropped and tar runs even if nothing is left
+        script = textwrap.dedent(f"""\
+            shopt -s nullglob
+            set -- {" ".join(quote_glob(path) for path in paths)}
+            if [ $# -eq 0 ]; then
+                exec tar -{flags} - -T /dev/null
+            fi
+            exec tar -{flags} - --ignore-failed-read -- "$@"
+            """)
+        cmd = f"cd ~ && {'sudo ' if sudo else ''}bash -c {shlex.quote(script)}"
+
+        written = []
+        errors = []
+
+        def extract(fd):
+            try:
+                with tarfile.open(fileobj=fd, mode="r|gz" if compress else "r|") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        name = tar_member_name(member.name, rename)
+                        utils.debug(f"SSH-FILE-GET-TAR: remote '{member.name}' "
+                            f"-> local '{localpath}{name}'")
+                        with open(f"{localpath}{name}", "wb") as local_fd:
+                            shutil.copyfileobj(tar.extractfile(member), local_fd)
+                        written.append(f"{localpath}{name}")
+            except Exception as e:
+                errors.append(f"extracting: {e!r}")
+            finally:
+                # keep reading so that the channel never blocks on a full pipe
+                while fd.read(READ_CHUNK_SIZE):
+                    pass
+                fd.close()
+
+        # the archive goes through a pipe to a thread because tarfile wants to
+        # pull data, while we need to keep pushing both streams of the channel
+        read_fd, write_fd = os.pipe()
+        extractor = threading.Thread(target=extract, args=(os.fdopen(read_fd, "rb"),))
+        extractor.start()
+        stderr_sink = OutputSink(io.StringIO())
+        stderr_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with tracing.span("ssh-file-get-tar", f"tar of {len(paths)} paths",
+                          host=self.host, paths=paths) as span:
+            with os.fdopen(write_fd, "wb") as pipe:
+                channel = self.__open_session(cmd, False, False)
+                rc = self.__drain(channel, pipe.write,
+                                  lambda data: stderr_sink.write(stderr_decoder.decode(data)),
+                                  span)
+            extractor.join()
+            span["files"] = len(written)
+
+        if stderr := stderr_sink.getvalue().rstrip():
+            utils.debug(f"SSH-FILE-GET-TAR: remote tar said:\n{stderr}")
+        # tar returns 1 when files changed while being read, which is normal for logs
+        if rc not in (0, 1):
+            errors.append(f"remote tar failed with rc {rc}")
+        if errors:
+            utils.debug(f"SSH-FILE-GET-TAR: transfer failed: {errors}")
+        return written, errors
 
 
     def file_read(self, remotepath):
-        self.__connect()
         utils.debug(f"SSH-FILE-READ: reading remote path '{self.host}:{remotepath}'")
-        sftp_channel = paramiko.SFTPClient.from_transport(self.transport)
-        fd = sftp_channel.open(remotepath, mode='r')
-        data = fd.read()
-        sftp_channel.close()
-        return data
+
+        def read(sftp):
+            with sftp.open(remotepath, mode='r') as fd:
+                # ask for all blocks up front instead of one round trip per block
+                fd.prefetch()
+                data = fd.read()
+                return data, len(data)
+
+        return self.__sftp_run("sftp-read", remotepath, read)
 
 
     def file_write(self, remotepath, contents):
-        self.__connect()
         utils.debug(f"SSH-FILE-WRITE: writing remote path '{self.host}:{remotepath}'")
-        sftp_channel = paramiko.SFTPClient.from_transport(self.transport)
-        fd = sftp_channel.open(remotepath, mode='w')
-        fd.write(contents)
-        sftp_channel.close()
+
+        def write(sftp):
+            with sftp.open(remotepath, mode='w') as fd:
+                # do not wait for the ack of each block before sending the next
+                fd.set_pipelined(True)
+                fd.write(contents)
+            return None, len(contents)
+
+        self.__sftp_run("sftp-write", remotepath, write)
@@ -0,0 +1,240 @@
+#!/bin/false
+
+"""
+A small engine to run a deploy as a graph of steps instead of a long script.
+
+Each step declares where it runs (host), what it runs (a remote command or a
+python function), which steps it depends on, how to retry and how to tell if
+it worked. The runner starts every step as soon as its dependencies are done,
+so independent steps (i.e. preparing different nodes) run at the same time,
+and prints the duration of each step and the critical path at the end. When a
+step fails, the commands still running in other steps are stopped instead of
+waiting for them to finish.
+
+Steps are checkpointed (see checkpoint.py) unless they are marked as not
+resumable, so a resumed deploy skips whatever still holds on the remote side.
+"""
+
+import concurrent.futures
+import threading
+import checkpoint
+import fanout
+import tracing
+import utils
+from sshclient import SSHClient, CANCELLED_RC
+
+# what deploy commands use unless the step says otherwise
+EXECUTE_ARGS = {"verbose": True, "get_pty": True, "combine_stderr": True, "filtered": True}
+
+
+class Step:
+    """One unit of work in the graph.
+
+       name: unique name, also used as log prefix and checkpoint name
+       cmd: remote command, or callable(results) returning it
+       function: callable(sshclient, results) returning a dict of outputs, used
+           instead of cmd for anything that is not a single command. sshclient
+           is None for steps without host. Only these outputs are checkpointed,
+           the outputs of a cmd step ({'out', 'rc'}) are there when it ran in
+           this same run, a skipped one gives {}: anything a later step needs
+           from a command has to come from a function step
+       host: address to run on (None for local functions)
+       deps: names of the steps that must be done before this one
+       error: message to die with when the step fails
+       retry_policy: a retrypolicy.RetryPolicy for the command (it retries
+           inside execute, on the failures it knows about)
+       watchdog: a watchdog.Watchdog for commands that can go silent for long
+       retries, retry_delay: run again up to retries times on any failure,
+           waiting retry_delay
+       check_rc: if False a failing cmd is only logged
+       resumable, inputs, check: see Checkpoint.done, inputs can be a
+           callable(results) and check is a command run on host
+       reconnect: drop the SSH connection when done (i.e. to pick new groups)
+       execute_args: overrides for SSHClient.execute arguments
+    """
+
+    def __init__(self, name, cmd=None, function=None, host=None, deps=(), error=None,
+                 retry_policy=None, watchdog=None, retries=0, retry_delay=10, check_rc=True,
+                 resumable=True, inputs=None, check=None, reconnect=False,
+                 execute_args=None):
+        if (cmd is None) == (function is None):
+            raise ValueError(f"step {name} needs either cmd or function")
+        self.name = name
+        self.cmd = cmd
+        self.function = function
+        self.host = host
+        self.deps = list(deps)
+        self.error = error or f"step {name} failed, aborting"
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.check_rc = check_rc
+        self.resumable = resumable
+        self.inputs = inputs
+        self.check = check
+        self.reconnect = reconnect
+        self.execute_args = dict(EXECUTE_ARGS, **(execute_args or {}))
+        if retry_policy:
+            self.execute_args["retry_policy"] = retry_policy
+        if watchdog:
+            self.execute_args["watchdog"] = watchdog
+
+
+class StepRunner:
+
+    def __init__(self, user, checkpoints=None, max_workers=fanout.MAX_WORKERS):
+        self.user = user
+        self.checkpoints = checkpoints
+        self.max_workers = max_workers
+        self.steps = {}
+        # name -> outputs of the steps that are done
+        self.results = {}
+        # name -> {'status', 'duration', 'start'}
+        self.report = {}
+        # set by the first failing step, stops the commands of the others
+        self.cancel_event = threading.Event()
+        # names of the steps stopped that way
+        self.cancelled = set()
+
+
+    def add(self, step):
+        if step.name in self.steps:
+            raise ValueError(f"duplicated step {step.name}")
+        self.steps[step.name] = step
+        return step
+
+
+    def __validate(self):
+        for step in self.steps.values():
+            for dep in step.deps:
+                if dep not in self.steps:
+                    utils.die(f"step {step.name} depends on unknown step {dep}")
+        # a graph with a cycle would just hang waiting, better to fail early
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visiting:
+                utils.die(f"dependency cycle found at step {name}")
+            if name not in visited:
+                visiting.add(name)
+                for dep in self.steps[name].deps:
+                    visit(dep)
+                visiting.remove(name)
+                visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+
+    def __execute(self, step, sshclient):
+        cmd = step.cmd(self.results) if callable(step.cmd) else step.cmd
+        for attempt in range(step.retries + 1):
+            if attempt:
+                utils.debug(f"retrying (attempt {attempt + 1}) in {step.retry_delay}s")
+                utils.sleep(step.retry_delay)
+            out, rc = sshclient.execute(cmd, cancel_event=self.cancel_event,
+                                        **step.execute_args)
+            utils.debug(f"execute return code is {rc}")
+            if rc == 0:
+                break
+            if rc == CANCELLED_RC:
+                self.cancelled.add(step.name)
+                utils.die(f"{step.name} stopped, another step failed")
+        if rc != 0:
+            if step.check_rc:
+                utils.die(step.error)
+            utils.debug(f"{step.name} failed -- ignoring")
+        return {"out": out, "rc": rc}
+
+
+    def __run_step(self, step):
+        """Runs one step in a worker thread, returns its outputs or dies"""
+        sshclient = SSHClient(self.user, step.host) if step.host else None
+        try:
+            inputs = step.inputs(self.results) if callable(step.inputs) else step.inputs
+            if step.resumable and self.checkpoints:
+                check = checkpoint.remote_check(sshclient, step.check) \
+                    if step.check and sshclient else None
+                if self.checkpoints.done(step.name, inputs=inputs, check=check):
+                    return self.checkpoints.outputs(step.name), "skipped"
+            with tracing.span("step", step.name, host=step.host or "local"):
+                if step.function:
+                    outputs = step.function(sshclient, self.results) or {}
+                else:
+                    outputs = self.__execute(step, sshclient)
+            if step.resumable and self.checkpoints:
+                # command output is only useful for the steps that come after
+                # in this same run, no need to keep it in the state file
+                self.checkpoints.record(step.name, inputs=inputs,
+                                        outputs=outputs if step.function else None)
+            return outputs, "done"
+        finally:
+            if sshclient:
+                sshclient.close(discard=step.reconnect)
+
+
+    def run(self):
+        """Runs all steps, dies (after the running ones finish) if any fails"""
+        self.__validate()
+        pending = dict(self.steps)
+        running = {}
+        failed = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if not failed:
+                    for name, step in list(pending.items()):
+                        if all(dep in self.results for dep in step.deps):
+                            utils.debug(f"STEP: starting {name}")
+                            self.report[name] = {"status": "running"}
+                            running[executor.submit(
+                                fanout.run_item, self.__run_step, step,
+                                label=lambda x: x.name,
+                                cancel_event=self.cancel_event)] = name
+                            del pending[name]
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    item = future.result()
+                    self.report[name]["duration"] = item["duration"]
+                    if item["error"] == "cancelled" or name in self.cancelled:
+                        self.report[name]["status"] = "cancelled"
+                        continue
+                    if item["error"]:
+                        self.report[name]["status"] = "failed"
+                        failed = failed or name
+                        continue
+                    self.results[name], self.report[name]["status"] = item["result"]
+                    utils.debug(f"STEP: {name} {self.report[name]['status']} "
+                                f"in {item['duration']:.1f}s")
+        for name in pending:
+            self.report[name] = {"status": "not run", "duration": 0}
+        self.print_report()
+        if failed:
+            utils.die(f"step {failed} failed, aborting")
+        return self.results
+
+
+    def critical_path(self):
+        """The chain of dependencies that took the longest, which is what
+           bounds the total time no matter how much else runs in parallel"""
+        longest = {}
+
+        def finish(name):
+            if name not in longest:
+                before = max((finish(dep) for dep in self.steps[name].deps),
+                             key=lambda x: x[0], default=(0, []))
+                duration = self.report.get(name, {}).get("duration", 0)
+                longest[name] = (before[0] + duration, before[1] + [name])
+            return longest[name]
+
+        return max((finish(name) for name in self.steps), key=lambda x: x[0], default=(0, []))
+
+
+    def print_report(self):
+        utils.debug("STEP: summary of deploy steps")
+        for name, item in self.report.items():
+            utils.debug(f"STEP: {item.get('duration', 0):9.1f}s {item['status']:9} {name}")
+        total, path = self.critical_path()
+        utils.debug(f"STEP: critical path ({total:.1f}s): {' -> '.join(path)}")
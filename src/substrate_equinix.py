@@ -1,10 +1,20 @@
 #!/bin/false
 
+import fanout
+import ipalloc
 import os
+import pkgcache
+import terraform
+import threading
 import utils
 import textwrap
 from sshclient import SSHClient
 
+# per host logs of configure_hosts
+LOG_DIR = "artifacts/substrate"
+
+tf = terraform.Terraform("terraform/equinix")
+
 
 def execute(jenkins_config, jenkins_creds, profile_data, action):
     # use env so that sensitive info does not show in debug log
@@ -22,37 +32,29 @@ def execute(jenkins_config, jenkins_creds, profile_data, action):
 
 def build(jenkins_config, jenkins_creds, profile_data):
     manifest = profile_data["manifest"]
+    # before provisioning, a profile with all its ip slices in use fails early
+    ip_lease = ipalloc.allocate(jenkins_config["profile"], profile_data, manifest)
 
     hosts_qty = len(jenkins_config["roles"])
     utils.debug(f"allocating {hosts_qty} hosts in equinix")
 
-    rc = utils.exec_cmd("terraform -chdir=terraform/equinix init -no-color")
-    if rc != 0:
-        utils.die("could not run terraform init")
-
-    rc = utils.exec_cmd("terraform -chdir=terraform/equinix apply -auto-approve -no-color" \
-                  f" -var='equinix_hosts_qty={hosts_qty}'")
-    if rc != 0:
-        utils.die("could not run terraform apply")
-
-    rc = utils.exec_cmd("terraform -chdir=terraform/equinix show -no-color")
-    if rc != 0:
-        utils.die("could not run terraform show")
+    tf.init()
+    tf.apply({"equinix_hosts_qty": hosts_qty})
+    tf.show()
 
-    equinix_vlans = utils.json_loads(
-        utils.exec_cmd_capture("terraform -chdir=terraform/equinix output "
-                               "-no-color -json equinix_vlans"))
-    utils.debug(f"captured 'equinix_vlans' terraform output: {equinix_vlans}")
-
-    equinix_hosts = utils.json_loads(
-        utils.exec_cmd_capture("terraform -chdir=terraform/equinix output "
-                               "-no-color -json equinix_hosts"))
-    utils.debug(f"captured 'equinix_hosts' terraform output: {equinix_hosts}")
+    equinix_vlans = tf.output("equinix_vlans")
+    equinix_hosts = tf.output("equinix_hosts")
 
     nodes = []
     nodes_roles = dict(zip(equinix_hosts.keys(), jenkins_config["roles"]))
+    prefix, start = "10.0.1.", 11
+    if ip_lease and ip_lease["nodes"]:
+        first, last = ip_lease["nodes"]
+        prefix, start = first.rsplit(".", 1)[0] + ".", int(first.rsplit(".", 1)[1])
+        if int(last.rsplit(".", 1)[1]) - start + 1 < hosts_qty:
+            utils.die(f"ip slice {ip_lease['nodes']} is too small for {hosts_qty} hosts")
     sunbeam_hostname_generator = utils.hostname_generator(
-        prefix="10.0.1.", start=11, domain="mydomain")
+        prefix=prefix, start=start, domain="mydomain")
     for nodename, ipaddress in equinix_hosts.items():
         s = next(sunbeam_hostname_generator)
         nodes.append({
@@ -72,41 +74,87 @@ def build(jenkins_config, jenkins_creds, profile_data):
     output_config["channel"] = jenkins_config["channel"]
     output_config["channelcp"] = jenkins_config["channelcp"]
     output_config["manifest"] = manifest
+    if ip_lease:
+        output_config["ip_slice"] = ip_lease["slice"]
+    if "snap_cache" in profile_data:
+        output_config["snap_cache"] = profile_data["snap_cache"]
 
     utils.write_config(output_config)
 
     # this substrate needs extra steps preparing the OS to be on par with maas substrate
-    configure_hosts(output_config, equinix_vlans)
+    configure_hosts(output_config, equinix_vlans, profile_data.get("package_cache"))
 
 
 def destroy(jenkins_config, jenkins_creds, profile_data):
     hosts_qty = len(jenkins_config["roles"])
-    rc = utils.exec_cmd("terraform -chdir=terraform/equinix destroy -auto-approve -no-color" \
-                        f" -var='equinix_hosts_qty={hosts_qty}'")
-    if rc != 0:
-        utils.die("could not run terraform destroy")
+    tf.destroy({"equinix_hosts_qty": hosts_qty})
 
 
-def configure_hosts(output_config, vlans):
-    vlan_oam = vlans["oam"]
-    vlan_ovn = vlans["ovn"]
+def configure_hosts(output_config, vlans, package_cache=None):
+    """Configures all hosts at the same time, the first one that fails stops
+       the others (their commands included) and the build dies. With a package
+       cache (see pkgcache.py) apt and snapd on the hosts go through it"""
 
-    # we need to collect all hostnames first (to use in /etc/hosts), then loop again later
+    # we need to collect all hostnames first (to use in /etc/hosts)
     etc_hosts_snippet = ""
     for node in output_config["nodes"]:
         host_name_int = node["host-name-int"]
         host_ip_int = node["host-ip-int"]
         etc_hosts_snippet += f"{host_ip_int}\t{host_name_int} {host_name_int.split('.')[0]}\n"
 
-    for node in output_config["nodes"]:
-        host_name_ext = node["host-name-ext"]
-        host_name_int = node["host-name-int"]
-        host_ip_ext = node["host-ip-ext"]
-        host_ip_int = node["host-ip-int"]
-
-        utils.debug(f"Starting configuration for host '{host_name_ext}'")
-
-        sshclient = SSHClient("root", host_ip_ext)
+    apt_proxy, snap_proxy, local_cache = pkgcache.get_proxies(package_cache)
+    if local_cache:
+        local_cache.start()
+        apt_proxy = local_cache.url
+    proxy_setup = pkgcache.remote_setup_cmd(apt_proxy, snap_proxy) \
+        if apt_proxy or snap_proxy else None
+    # a local cache is gone after the build, hosts must not keep using it
+    proxy_cleanup = pkgcache.remote_cleanup_cmd() if local_cache else None
+
+    os.makedirs(utils.run_path(LOG_DIR), exist_ok=True)
+    cancel_event = threading.Event()
+    try:
+        results = fanout.parallel_map(
+            lambda node: configure_host(node, vlans, etc_hosts_snippet, cancel_event,
+                                        proxy_setup, proxy_cleanup),
+            output_config["nodes"], label=lambda x: x["host-name-int"],
+            cancel_event=cancel_event)
+    finally:
+        if local_cache:
+            local_cache.stop()
+            local_cache.write_report()
+
+    failed = []
+    for name, result in results.items():
+        utils.debug(f"configure host {name}: {result['error'] or 'ok'} "
+                    f"in {result['duration']:.1f}s")
+        if result["error"]:
+            failed.append(name)
+    if failed:
+        utils.die(f"configuring hosts failed for {failed}, aborting")
+
+
+def configure_host(node, vlans, etc_hosts_snippet, cancel_event,
+                   proxy_setup=None, proxy_cleanup=None):
+    vlan_oam = vlans["oam"]
+    vlan_ovn = vlans["ovn"]
+    host_name_ext = node["host-name-ext"]
+    host_name_int = node["host-name-int"]
+    host_ip_ext = node["host-ip-ext"]
+    host_ip_int = node["host-ip-int"]
+
+    utils.debug(f"Starting configuration for host '{host_name_ext}'")
+
+    sshclient = SSHClient("root", host_ip_ext)
+    # each host also gets its whole output in its own log file
+    log = open(utils.run_path(LOG_DIR, f"{host_name_int}-configure.txt"), "a", encoding="utf-8")
+    try:
+        if proxy_setup:
+            out, rc = sshclient.execute(
+                proxy_setup, verbose=True, get_pty=False, combine_stderr=True, filtered=False,
+                sink=log, cancel_event=cancel_event)
+            if rc != 0:
+                utils.die("error configuring package proxies, aborting")
 
         cmd = """set -xe
             apt -q update
@@ -117,10 +165,18 @@ def configure_hosts(output_config, vlans):
             apt install -y bridge-utils
             """
         out, rc = sshclient.execute(
-            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=True)
+            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=True,
+            sink=log, cancel_event=cancel_event)
         if rc != 0:
             utils.die("running apt update/upgrade failed, aborting")
 
+        if proxy_cleanup:
+            out, rc = sshclient.execute(
+                proxy_cleanup, verbose=True, get_pty=False, combine_stderr=True, filtered=False,
+                sink=log, cancel_event=cancel_event)
+            if rc != 0:
+                utils.die("error removing package proxy settings, aborting")
+
         cmd = textwrap.dedent(f"""\
             set -xe
             echo "
@@ -149,7 +205,8 @@ def configure_hosts(output_config, vlans):
             systemctl restart networking
             """)
         out, rc = sshclient.execute(
-            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=False)
+            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=False,
+            sink=log, cancel_event=cancel_event)
         if rc != 0:
             utils.die("error updating network configs, aborting")
 
@@ -168,8 +225,10 @@ def configure_hosts(output_config, vlans):
             cat /root/.ssh/authorized_keys >> /home/ubuntu/.ssh/authorized_keys
         """
         out, rc = sshclient.execute(
-            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=False)
+            cmd, verbose=True, get_pty=False, combine_stderr=True, filtered=False,
+            sink=log, cancel_event=cancel_event)
         if rc != 0:
             utils.die("error configuring ubuntu user, aborting")
-
+    finally:
+        log.close()
         sshclient.close()
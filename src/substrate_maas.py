@@ -1,8 +1,12 @@
 #!/bin/false
 
+import ipalloc
 import os
+import terraform
 import utils
 
+tf = terraform.Terraform("terraform/maas")
+
 
 def execute(jenkins_config, jenkins_creds, profile_data, action):
     # use env so that sensitive info does not show in debug log
@@ -21,26 +25,17 @@ def execute(jenkins_config, jenkins_creds, profile_data, action):
 def build(jenkins_config, jenkins_creds, profile_data):
 
     manifest = profile_data["manifest"]
+    # before provisioning, a profile with all its ip slices in use fails early
+    ip_lease = ipalloc.allocate(jenkins_config["profile"], profile_data, manifest)
 
     hosts_qty = len(jenkins_config["roles"])
     utils.debug(f"allocating {hosts_qty} hosts in maas")
 
-    rc = utils.exec_cmd("terraform -chdir=terraform/maas init -no-color")
-    if rc != 0:
-        utils.die("could not run terraform init")
-
-    rc = utils.exec_cmd("terraform -chdir=terraform/maas apply -auto-approve -no-color" \
-                  f" -var='maas_hosts_qty={hosts_qty}'")
-    if rc != 0:
-        utils.die("could not run terraform apply")
-
-    rc = utils.exec_cmd("terraform -chdir=terraform/maas show -no-color")
-    if rc != 0:
-        utils.die("could not run terraform show")
+    tf.init()
+    tf.apply({"maas_hosts_qty": hosts_qty})
+    tf.show()
 
-    maas_hosts = utils.json_loads(
-        utils.exec_cmd_capture("terraform -chdir=terraform/maas output -no-color -json maas_hosts"))
-    utils.debug(f"captured 'maas_hosts' terraform output: {maas_hosts}")
+    maas_hosts = tf.output("maas_hosts")
 
     nodes = []
     nodes_roles = dict(zip(maas_hosts.keys(), jenkins_config["roles"]))
@@ -62,13 +57,14 @@ def build(jenkins_config, jenkins_creds, profile_data):
     output_config["channel"] = jenkins_config["channel"]
     output_config["channelcp"] = jenkins_config["channelcp"]
     output_config["manifest"] = manifest
+    if ip_lease:
+        output_config["ip_slice"] = ip_lease["slice"]
+    if "snap_cache" in profile_data:
+        output_config["snap_cache"] = profile_data["snap_cache"]
 
     utils.write_config(output_config)
 
 
 def destroy(jenkins_config, jenkins_creds, profile_data):
     hosts_qty = len(jenkins_config["roles"])
-    rc = utils.exec_cmd("terraform -chdir=terraform/maas destroy -auto-approve -no-color" \
-                        f" -var='maas_hosts_qty={hosts_qty}'")
-    if rc != 0:
-        utils.die("could not run terraform destroy")
+    tf.destroy({"maas_hosts_qty": hosts_qty})
@@ -1,6 +1,7 @@
 #!/bin/false
 
 import json
+import terraform
 import utils
 import os
 from sshclient import SSHClient
@@ -15,11 +16,11 @@ from sshclient import SSHClient
 
 
 USER = "ubuntu"  # for ssh'ing into sunbeam-client
-tf_cmd = "terraform -chdir=terraform/maas_deployment"
+tf = terraform.Terraform("terraform/maas_deployment")
 destroy_cmd_options = "--destroy-storage --no-prompt --force --no-wait"
 
 
-def generate_terraform_cmd(profile_data, action="apply"):
+def terraform_variables(profile_data, action="apply"):
     distro_series = profile_data["distro_series"]
     infra_host = profile_data["infra_host"]
     deployment_name = profile_data["deployment_name"]
@@ -33,20 +34,18 @@ def generate_terraform_cmd(profile_data, action="apply"):
         utils.debug(f"Using {infra_host} as an LXD host in MAAS")
         utils.debug(f"Using {cloud_nodes} for OpenStack cloud")
         utils.debug(f"API ranges: {api_ranges}")
-    return (
-        f"{tf_cmd} {action} -auto-approve -no-color"
-        f" -var='cloud_nodes={cloud_nodes}'"
-        f" -var='distro_series={distro_series}'"
-        f" -var='infra_host={infra_host}'"
-        f" -var='deployment_name={deployment_name}'"
-        f" -var='api_ranges={api_ranges}'"
-    )
+    return {
+        "cloud_nodes": cloud_nodes,
+        "distro_series": distro_series,
+        "infra_host": infra_host,
+        "deployment_name": deployment_name,
+        "api_ranges": api_ranges,
+    }
 
 
 def get_sunbeam_client():
-    return utils.exec_cmd_capture(
-        f"{tf_cmd} output -no-color -raw sunbeam_client"
-    )
+    # None when there is no deployment (no terraform state)
+    return tf.output("sunbeam_client")
 
 
 def execute(jenkins_config, jenkins_creds, profile_data, action):
@@ -63,21 +62,14 @@ def execute(jenkins_config, jenkins_creds, profile_data, action):
 
 
 def build(jenkins_config, jenkins_creds, profile_data):
-    rc = utils.exec_cmd(f"{tf_cmd} init -no-color")
-    if rc != 0:
-        utils.die("could not run terraform init")
+    tf.init()
 
     # remove a possible left over install before starting
     utils.debug("Removing any old deployment left over")
     destroy(jenkins_config, jenkins_creds, profile_data, "destroy")
 
-    rc = utils.exec_cmd(generate_terraform_cmd(profile_data, action="apply"))
-    if rc != 0:
-        utils.die("could not run terraform apply")
-
-    rc = utils.exec_cmd(f"{tf_cmd} show -no-color")
-    if rc != 0:
-        utils.die("could not run terraform show")
+    tf.apply(terraform_variables(profile_data, action="apply"))
+    tf.show()
 
     sunbeam_client = get_sunbeam_client()
 
@@ -95,6 +87,8 @@ def build(jenkins_config, jenkins_creds, profile_data):
     output_config["channel"] = jenkins_config["channel"]
     output_config["channelcp"] = jenkins_config["channelcp"]
     output_config["manifest"] = profile_data["manifest"]
+    if "snap_cache" in profile_data:
+        output_config["snap_cache"] = profile_data["snap_cache"]
 
     utils.write_config(output_config)
 
@@ -113,18 +107,14 @@ def destroy(jenkins_config, jenkins_creds, profile_data, action):
         remove_current_installation(
             jenkins_config, jenkins_creds, profile_data
         )
-        rc = utils.exec_cmd(
-            generate_terraform_cmd(profile_data, action="destroy")
-        )
-        if rc != 0:
-            utils.die("could not run terraform destroy")
+        tf.destroy(terraform_variables(profile_data, action="destroy"))
     else:
         utils.debug("Keeping deployment up so it can be used later")
 
 
 def remove_current_installation(jenkins_config, jenkins_creds, profile_data):
     sunbeam_client = get_sunbeam_client()
-    if sunbeam_client.startswith("\nWarning"):
+    if not sunbeam_client:
         return
 
     sshclient = SSHClient(USER, sunbeam_client)
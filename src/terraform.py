@@ -0,0 +1,123 @@
+#!/bin/false
+
+"""
+Thin wrapper around the terraform CLI used by the substrates.
+
+- All outputs are read with a single 'terraform output -json' and kept until the
+  next apply/destroy, instead of a terraform process per output.
+- Providers go to a persistent plugin cache shared by all workspaces and builds,
+  inits hold a lock on it as terraform does not support concurrent use of it.
+- 'terraform init' is skipped when the directory was already initialized for
+  the same configuration (same .tf files).
+- With a run directory (see utils.run_path) the .tf files are copied there and
+  terraform runs in that copy, so each run has its own state and .terraform.
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import utils
+
+PLUGIN_CACHE_DIR = "~/.cache/sunbeam-ci/terraform-plugins"
+
+# held while terraform init fills the plugin cache
+PLUGIN_CACHE_LOCK = "~/.cache/sunbeam-ci/terraform-plugins.lock"
+
+# written in the .terraform dir after a successful init
+INIT_STAMP = ".terraform/sunbeam-ci-init"
+
+
+def setup_env():
+    plugin_cache_dir = os.path.expanduser(PLUGIN_CACHE_DIR)
+    os.makedirs(plugin_cache_dir, exist_ok=True)
+    os.environ.setdefault("TF_PLUGIN_CACHE_DIR", plugin_cache_dir)
+    # lock files are not kept in git, without this terraform would not use
+    # the cache for a workspace that has none yet
+    os.environ.setdefault("TF_PLUGIN_CACHE_MAY_BREAK_DEPENDENCY_LOCK_FILE", "true")
+
+
+def variables_options(variables):
+    """-var options for a {name: value} dict, values already in terraform syntax"""
+    return "".join(f" -var='{name}={value}'" for name, value in (variables or {}).items())
+
+
+class Terraform:
+
+    def __init__(self, source):
+        self.source = source
+        self.outputs_cache = None
+
+
+    @property
+    def directory(self):
+        """Where terraform runs (and keeps its state) for the current run"""
+        return utils.run_path(self.source)
+
+
+    def cmd(self, action, options=""):
+        return f"terraform -chdir={self.directory} {action} -no-color{options}"
+
+
+    def run(self, action, options="", error=None):
+        """Runs a terraform command, dies with error (if given) when it fails"""
+        rc = utils.exec_cmd(self.cmd(action, options))
+        if rc != 0 and error:
+            utils.die(error)
+        return rc
+
+
+    def config_hash(self):
+        digest = hashlib.sha256()
+        for filename in sorted(glob.glob(f"{self.source}/*.tf")):
+            digest.update(os.path.basename(filename).encode("utf-8"))
+            digest.update(utils.read_file(filename).encode("utf-8"))
+        return digest.hexdigest()
+
+
+    def init(self):
+        setup_env()
+        if os.path.abspath(self.directory) != os.path.abspath(self.source):
+            os.makedirs(self.directory, exist_ok=True)
+            for filename in glob.glob(f"{self.source}/*.tf") + glob.glob(f"{self.source}/*.tfvars"):
+                shutil.copy(filename, self.directory)
+        stamp = f"{self.directory}/{INIT_STAMP}"
+        config_hash = self.config_hash()
+        if os.path.isfile(stamp) and utils.read_file(stamp).strip() == config_hash:
+            utils.debug(f"terraform already initialized in {self.directory}, skipping init")
+            return
+        # other builds on the agent may be running init at the same time
+        with utils.file_lock(os.path.expanduser(PLUGIN_CACHE_LOCK)):
+            self.run("init", error="could not run terraform init")
+        utils.write_file(config_hash, stamp)
+
+
+    def apply(self, variables=None):
+        self.outputs_cache = None
+        self.run("apply", " -auto-approve" + variables_options(variables),
+                 error="could not run terraform apply")
+
+
+    def destroy(self, variables=None):
+        self.outputs_cache = None
+        self.run("destroy", " -auto-approve" + variables_options(variables),
+                 error="could not run terraform destroy")
+
+
+    def show(self):
+        self.run("show", error="could not run terraform show")
+
+
+    def outputs(self):
+        """All outputs as {name: value}, empty when there is no state"""
+        if self.outputs_cache is None:
+            out = utils.exec_cmd_capture(self.cmd("output", " -json"))
+            self.outputs_cache = {
+                name: output["value"] for name, output in utils.json_loads(out or "{}").items()}
+        return self.outputs_cache
+
+
+    def output(self, name):
+        value = self.outputs().get(name)
+        utils.debug(f"captured '{name}' terraform output: {value}")
+        return value
@@ -0,0 +1,122 @@
+#!/bin/false
+
+"""
+Records a timing span for every remote command, file transfer and local command
+(terraform included) and writes them, at the end of each stage, to a JSON file
+in Chrome trace format inside artifacts/ so that it gets archived with the build.
+
+Load the file in chrome://tracing or https://ui.perfetto.dev to see a timeline
+with one row per host. Timestamps are absolute, so the files of different stages
+(and builds) line up and can be compared.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+TRACE_DIR = "artifacts"
+
+_lock = threading.Lock()
+_spans = []
+_stage = None
+_registered = False
+
+
+def start_stage(stage):
+    """Names the current stage and writes its trace file when the process ends
+       (including when it ends with utils.die)"""
+    global _stage, _registered
+    # another stage in the same process (see pipeline.py) gets its own file
+    if _stage:
+        end_stage()
+    _stage = stage
+    if not _registered:
+        atexit.register(write_trace)
+        _registered = True
+
+
+def end_stage():
+    """Writes the trace file of the current stage and starts over"""
+    global _stage
+    write_trace()
+    with _lock:
+        _spans.clear()
+    _stage = None
+
+
+@contextlib.contextmanager
+def span(category, label, host="local", **args):
+    """Times the code inside the with block. Yields a dict where the caller can
+       add what it learns while running (i.e. 'rc' and 'bytes')"""
+    record = dict(args)
+    start = time.time()
+    try:
+        yield record
+    finally:
+        end = time.time()
+        with _lock:
+            _spans.append({
+                "category": category,
+                "label": label,
+                "host": host,
+                "start": start,
+                "duration": end - start,
+                "args": record,
+            })
+
+
+def command_label(cmd, length=80):
+    """A short one line label for a (possibly multi line) command"""
+    # shell options (set -xe) say nothing about what the command does
+    lines = [re.sub(r"^set -\w+;?\s*", "", line.strip()) for line in cmd.splitlines()]
+    lines = [line for line in lines if line] or [""]
+    label = lines[0] + (" ..." if len(lines) > 1 else "")
+    return label if len(label) <= length else label[:length - 3] + "..."
+
+
+def get_spans():
+    with _lock:
+        return list(_spans)
+
+
+def to_chrome_trace(spans, stage):
+    """Converts spans to Chrome trace format, one row (thread) per host"""
+    hosts = {}
+    events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0,
+               "args": {"name": stage}}]
+    for item in spans:
+        if item["host"] not in hosts:
+            hosts[item["host"]] = len(hosts) + 1
+            events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                           "tid": hosts[item["host"]], "args": {"name": item["host"]}})
+        events.append({
+            "name": item["label"],
+            "cat": item["category"],
+            "ph": "X",
+            "ts": int(item["start"] * 1000000),
+            "dur": int(item["duration"] * 1000000),
+            "pid": 1,
+            "tid": hosts[item["host"]],
+            "args": item["args"],
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_trace():
+    spans = get_spans()
+    if not _stage or not spans:
+        return
+    # not using utils here (nor its run_path) because utils itself records spans
+    trace_dir = os.path.join(os.environ.get("SUNBEAM_RUN_DIR") or ".", TRACE_DIR)
+    os.makedirs(trace_dir, exist_ok=True)
+    filename = os.path.normpath(f"{trace_dir}/trace-{_stage}.json")
+    print(f"DEBUG: writing {len(spans)} trace spans to {filename}")
+    with open(filename, "w", encoding="utf-8") as fd:
+        json.dump(to_chrome_trace(spans, _stage), fd)
+    for item in sorted(spans, key=lambda x: x["duration"], reverse=True)[:10]:
+        print(f"DEBUG: TRACE {item['duration']:9.1f}s {item['host']} "
+              f"{item['category']} {item['label']}")
@@ -1,19 +1,58 @@
 #!/bin/false
 
 import base64
+import contextlib
+import copy
+import fcntl
 import glob
 import json
 import mergedeep
+import os
 import pathlib
 import subprocess
 import sys
+import threading
 import time
+import tracing
 import yaml
 
 
+# per thread context, so parallel work on many hosts can be told apart in the log
+_log_context = threading.local()
+
+# config.yaml parsed once per process (and version of the file)
+_config_cache = {}
+
+# everything a run writes (config, deploy state, artifacts, terraform state and
+# workspace) goes under this directory, so that several runs can share one
+# checkout on the agent, i.e. SUNBEAM_RUN_DIR=runs/ob76-1 (default: current dir)
+RUN_DIR_ENV = "SUNBEAM_RUN_DIR"
+
+
 def debug(msg):
     """Print debug messages on stdout"""
-    print(f"DEBUG: {msg}")
+    if prefix := get_log_prefix():
+        print(f"DEBUG: [{prefix}] {msg}")
+    else:
+        print(f"DEBUG: {msg}")
+
+
+def console(text):
+    """Print command output on stdout (text should already end in a newline),
+       prefixed with the host name when running in parallel"""
+    if prefix := get_log_prefix():
+        text = "".join(f"[{prefix}] {line}" for line in text.splitlines(keepends=True))
+    # a single write so that lines from different threads do not get mixed
+    sys.stdout.write(text)
+
+
+def set_log_prefix(prefix):
+    """Sets the prefix for messages printed by the current thread"""
+    _log_context.prefix = prefix
+
+
+def get_log_prefix():
+    return getattr(_log_context, "prefix", None)
 
 
 def die(msg):
@@ -25,18 +64,28 @@ def die(msg):
 def exec_cmd(cmd):
     """Exec code locally using shell"""
     debug(f"EXEC: {cmd}")
-    result = subprocess.run(f"set -x; {cmd}", shell=True, check=False)
+    with tracing.span(exec_category(cmd), tracing.command_label(cmd)) as span:
+        result = subprocess.run(f"set -x; {cmd}", shell=True, check=False)
+        span["rc"] = result.returncode
     return result.returncode
 
 
 def exec_cmd_capture(cmd):
     """Execute a shell command and grab the output"""
     debug(f"EXEC-CAPTURE: {cmd}")
-    result = subprocess.run(cmd, shell=True, check=False,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with tracing.span(exec_category(cmd), tracing.command_label(cmd)) as span:
+        result = subprocess.run(cmd, shell=True, check=False,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        span["rc"] = result.returncode
+        span["bytes"] = len(result.stdout)
     return result.stdout.decode()
 
 
+def exec_category(cmd):
+    """Trace category of a local command, terraform calls get their own"""
+    return "terraform" if cmd.split(maxsplit=1)[:1] == ["terraform"] else "local-exec"
+
+
 def hostname_generator(prefix, start, domain): 
     octets = prefix.split(".")
     # if start is None, use last octet as first
@@ -70,17 +119,64 @@ def read_file_lines(filename, encoding='utf-8'):
         return fd.readlines()
 
 
+def run_dir():
+    return os.environ.get(RUN_DIR_ENV) or "."
+
+
+def run_path(*parts):
+    """A path inside the run directory"""
+    return os.path.normpath(os.path.join(run_dir(), *parts))
+
+
+def build_id():
+    """Identifies the build across its stages (separate processes)"""
+    return os.environ.get("BUILD_TAG") or os.path.abspath(run_dir())
+
+
+@contextlib.contextmanager
+def file_lock(filename, shared=False):
+    """Holds an exclusive (or shared) lock on filename (created if needed) among
+       the jobs on the agent, released on the way out"""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def locked_json(filename):
+    """Yields the dict in a JSON state file shared by the jobs on the agent,
+       with an exclusive lock held, and saves it on the way out"""
+    with file_lock(f"{filename}.lock"):
+        state = {}
+        if os.path.isfile(filename):
+            state = json.loads(read_file(filename) or "{}")
+        yield state
+        replace_file(json.dumps(state), filename)
+
+
 def read_profiles():
+    # a run can bring its own profiles, otherwise the shared ones are used
+    if os.path.isfile(filename := run_path("profiles.yaml")):
+        return yaml.safe_load(read_file(filename))
     return yaml.safe_load(read_file("profiles.yaml"))
 
 
 def read_config():
-    return yaml.safe_load(read_file("config.yaml"))
+    """Parses config.yaml only when it changed, so that the stages running in
+       one process share it (see pipeline.py), callers get their own copy"""
+    filename = run_path("config.yaml")
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    if _config_cache.get("key") != key:
+        _config_cache.update(key=key, config=yaml.safe_load(read_file(filename)))
+    return copy.deepcopy(_config_cache["config"])
 
 
 def write_config(config):
     debug(f"config to be written:\n{config}")
-    write_file(yaml.dump(config), "config.yaml")
+    os.makedirs(run_dir(), exist_ok=True)
+    write_file(yaml.dump(config), run_path("config.yaml"))
 
 
 def write_file(content, filename, encoding='utf-8'):
@@ -89,6 +185,14 @@ def write_file(content, filename, encoding='utf-8'):
         fd.write(content)
 
 
+def replace_file(content, filename, encoding='utf-8'):
+    """Same as write_file for state files: write and rename so that a crash
+       never leaves a truncated file"""
+    with open(f"{filename}.tmp", "w", encoding=encoding) as fd:
+        fd.write(content)
+    os.replace(f"{filename}.tmp", filename)
+
+
 def yaml_safe_load(yamlinput):
     return yaml.safe_load(yamlinput)
 
@@ -0,0 +1,144 @@
+#!/bin/false
+
+"""
+Inactivity watchdog for long remote commands (bootstrap, cluster deploy...)
+that can stay silent for an hour before sunbeam gives up on its own.
+
+When a command prints no new line for a while (spinner redraws do not count,
+see SSHClient.execute), the watchdog captures a snapshot of juju status, pods
+and ceph on a second channel of the same connection, in background, while the
+command keeps running. Snapshots go to artifacts/ and a
+summary goes to the log. If the caller opts in with abort=True, a known fatal
+state stops the command (it is not going to recover) and execute returns
+WATCHDOG_RC instead of waiting for the timeout. States that can also be
+transient only do it once they were seen in several snapshots in a row, until
+then they are just reported.
+
+Use it with SSHClient.execute(watchdog=Watchdog(...)).
+"""
+
+import os
+import re
+import threading
+import time
+import utils
+
+# rc returned when the watchdog stops a command
+WATCHDOG_RC = 1003
+
+WATCHDOG_DIR = "artifacts/watchdog"
+
+# name -> command, run in a single round trip, each one bounded in time
+DIAGNOSTICS = {
+    "juju-status": "timeout 60 juju status -m openstack 2>&1",
+    "pods": "timeout 60 sudo microk8s.kubectl get pods -n openstack 2>&1",
+    "ceph": "timeout 60 sudo ceph -s 2>&1",
+}
+
+# (name, diagnostic, regex, snapshots) states from which a deploy does not come
+# back once they were found in that many snapshots in a row. Juju retries failed
+# hooks on its own and ceph reports errors while the OSDs come up, so those two
+# need to last (snapshots are interval apart) before they count
+FATAL_STATES = [
+    ("ceph-health-err", "ceph", r"HEALTH_ERR", 3),
+    ("juju-install-hook-failed", "juju-status", r'hook failed: "install"', 3),
+    ("pods-image-pull-error", "pods", r"\bErrImagePull\b", 1),
+]
+
+
+class Watchdog:
+
+    def __init__(self, timeout=600, interval=600, abort=False,
+                 diagnostics=DIAGNOSTICS, fatal_states=FATAL_STATES):
+        """timeout: seconds without output before the first snapshot
+           interval: seconds between snapshots while it stays silent
+           abort: stop the command when a snapshot shows a fatal state"""
+        self.timeout = timeout
+        self.interval = interval
+        self.abort = abort
+        self.diagnostics = diagnostics
+        self.fatal_states = [(name, diag, re.compile(regex), snapshots)
+                             for name, diag, regex, snapshots in fatal_states]
+
+
+    def watch(self, sshclient, label):
+        """Returns a new watch for one run of a command on sshclient"""
+        return Watch(self, sshclient, label)
+
+
+class Watch:
+    """Follows one command run: when output was last seen and the snapshots"""
+
+    def __init__(self, watchdog, sshclient, label):
+        self.watchdog = watchdog
+        self.sshclient = sshclient
+        self.name = re.sub(r"[^\w.-]+", "_", label)[:40]
+        self.last_activity = time.monotonic()
+        self.last_snapshot = None
+        self.snapshots = 0
+        self.thread = None
+        self.fatal = None
+        # fatal state name -> consecutive snapshots it was found in
+        self.seen = {}
+        # the drain loop and the snapshot thread both update the above
+        self.lock = threading.Lock()
+
+
+    def activity(self):
+        with self.lock:
+            self.last_activity = time.monotonic()
+            # the command is moving again, states have to persist from scratch
+            self.seen = {}
+
+
+    def __snapshot(self, silent_for, log_prefix):
+        utils.set_log_prefix(log_prefix)
+        utils.debug(f"WATCHDOG: no output for {silent_for:.0f}s, capturing diagnostics")
+        self.snapshots += 1
+        watchdog_dir = utils.run_path(WATCHDOG_DIR)
+        prefix = f"{watchdog_dir}/{self.sshclient.host}-{self.name}-{time.strftime('%H%M%S')}"
+        os.makedirs(watchdog_dir, exist_ok=True)
+        try:
+            results = self.sshclient.execute_batch(self.watchdog.diagnostics)
+        except Exception as e:
+            utils.debug(f"WATCHDOG: could not capture diagnostics: {e!r}")
+            return
+        for diag, (out, rc) in results.items():
+            utils.write_file(out or "", f"{prefix}-{diag}.txt")
+            # just the gist in the log, the whole thing is in the artifacts
+            summary = (out or "").strip().splitlines()[-10:]
+            utils.debug(f"WATCHDOG: {diag} (rc={rc}):\n" + "\n".join(summary))
+        for name, diag, regex, snapshots in self.watchdog.fatal_states:
+            out = (results.get(diag) or ("", None))[0]
+            with self.lock:
+                if not (out and regex.search(out)):
+                    self.seen.pop(name, None)
+                    continue
+                seen = self.seen[name] = self.seen.get(name, 0) + 1
+                if seen >= snapshots and self.watchdog.abort and not self.fatal:
+                    self.fatal = name
+            if seen < snapshots:
+                utils.debug(f"WATCHDOG: '{name}' found in {diag} "
+                            f"({seen} of {snapshots} snapshots), diagnostic only")
+            else:
+                utils.debug(f"WATCHDOG: fatal state '{name}' found in {diag}")
+
+
+    def stop_rc(self):
+        """Called on every drain loop: starts a snapshot when it is time, and
+           returns WATCHDOG_RC once a fatal state was found (with abort)"""
+        with self.lock:
+            if self.fatal:
+                return WATCHDOG_RC
+            last_activity = self.last_activity
+        now = time.monotonic()
+        silent_for = now - last_activity
+        if silent_for < self.watchdog.timeout or (self.thread and self.thread.is_alive()):
+            return None
+        if self.last_snapshot and now - self.last_snapshot < self.watchdog.interval:
+            return None
+        self.last_snapshot = now
+        self.thread = threading.Thread(
+            target=self.__snapshot, args=(silent_for, utils.get_log_prefix()), daemon=True)
+        self.thread.start()
+        return None
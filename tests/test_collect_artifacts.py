@@ -0,0 +1,41 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import collect_artifacts  # noqa: E402
+import sshclient  # noqa: E402
+
+
+class LogFilesRenameTest(unittest.TestCase):
+
+    def local_name(self, member_name):
+        rename = [(re.compile(regex), replacement)
+                  for regex, replacement in collect_artifacts.LOG_FILES_RENAME]
+        return sshclient.tar_member_name(member_name, rename)
+
+    def test_terraform_logs_get_the_deployment_in_the_name(self):
+        prefix = "snap/openstack/common/etc/local"
+        self.assertEqual(
+            self.local_name(f"{prefix}/demo-setup/terraform-apply-20240101120000.log"),
+            "terraform_demo-setup-apply-20240101120000.log")
+        self.assertEqual(
+            self.local_name(f"{prefix}/deploy-microceph/terraform-init-20240101120000.log"),
+            "terraform_deploy-microceph-init-20240101120000.log")
+
+    def test_syslog_is_renamed(self):
+        self.assertEqual(self.local_name("var/log/syslog"), "syslog.txt")
+
+    def test_other_files_keep_their_base_name(self):
+        self.assertEqual(self.local_name("var/log/kern.log"), "kern.log")
+        self.assertEqual(self.local_name("snap/openstack/common/logs/sunbeam-1.log"),
+                         "sunbeam-1.log")
+        self.assertEqual(self.local_name(
+            "var/snap/openstack-hypervisor/common/log/ovn/ovn-controller.log"),
+            "ovn-controller.log")
+
+
+if __name__ == "__main__":
+    unittest.main()
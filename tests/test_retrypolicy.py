@@ -0,0 +1,68 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import retrypolicy  # noqa: E402
+
+IMAGE_TIMEOUT = [
+    "Error: Gateway Timeout\n",
+    "  with openstack_images_image_v2.ubuntu,\n",
+]
+
+
+def actions(policy, output, runs=10):
+    """The rules applied, in order, for a command that fails with output on
+       every run, the way SSHClient.execute goes through them"""
+    applied = []
+    triggered = {}
+    for _ in range(runs):
+        matcher = policy.matcher()
+        for line in output:
+            matcher.feed(line)
+        rule = matcher.rule(1, triggered)
+        if not rule or rule["action"] == retrypolicy.ABORT:
+            break
+        triggered[rule["name"]] = triggered.get(rule["name"], 0) + 1
+        applied.append(rule["name"])
+    return applied
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_ceph_workaround_goes_first_on_storage_primaries(self):
+        self.assertEqual(
+            actions(retrypolicy.CEPH_CONFIGURE_POLICY, IMAGE_TIMEOUT),
+            ["ceph-pool-min-size", "ubuntu-image-timeout", "ubuntu-image-timeout"])
+
+    def test_exhausted_rule_gives_way_to_the_next_one(self):
+        policy = retrypolicy.DEFAULT_POLICY.with_rules(retrypolicy.CEPH_MIN_SIZE_RULE)
+        self.assertEqual(
+            actions(policy, IMAGE_TIMEOUT),
+            ["ubuntu-image-timeout", "ubuntu-image-timeout", "ceph-pool-min-size"])
+
+    def test_configure_retries_any_failure_once(self):
+        policy = retrypolicy.DEFAULT_POLICY.with_rules(retrypolicy.CONFIGURE_RULE)
+        self.assertEqual(actions(policy, ["Error: something else\n"]),
+                         ["configure-any-failure"])
+
+    def test_abort_rule_stops_retries(self):
+        output = ["Error: Unable to list disks\n"]
+        self.assertEqual(actions(retrypolicy.CEPH_CONFIGURE_POLICY, output), [])
+
+    def test_cluster_operations_only_retry_websocket_errors(self):
+        self.assertEqual(actions(retrypolicy.CLUSTER_POLICY, IMAGE_TIMEOUT), [])
+        self.assertEqual(
+            actions(retrypolicy.CLUSTER_POLICY, ["Error: Unable to connect to websocket\n"]),
+            ["websocket-error"])
+
+    def test_success_applies_no_rule(self):
+        matcher = retrypolicy.DEFAULT_POLICY.matcher()
+        for line in IMAGE_TIMEOUT:
+            matcher.feed(line)
+        self.assertIsNone(matcher.rule(0))
+
+
+if __name__ == "__main__":
+    unittest.main()